@@ -1,8 +1,57 @@
 #!/usr/bin/env python3
 
-# pip install matplotlib
+# pip install matplotlib numpy
+# matplotlib is only needed for plots, and is imported lazily with the Agg backend
+
+# ./401k.py plots one deterministic path at annual_growth_rate into out/401k.png
+# ./401k.py --paths 100000 runs a monte carlo over random market returns instead,
+# printing the chance each account lasts to 110 and plotting percentile bands
+# into out/401k_monte_carlo.png. returns are drawn from a normal or lognormal
+# distribution around annual_growth_rate, or bootstrapped from a file of
+# historical annual returns (one decimal return per line, e.g. 0.12)
+# ./401k.py --bench-tax checks the exact gross withdrawal solver against the old
+# iterative one and times them
+# ./401k.py --sweep retirement_age=55:70:1 --sweep annual_growth_rate=0.03:0.08:0.005
+# runs every combination across a process pool and prints/plots the age each account
+# runs out of money. results are cached in ~/.cache/401k_sweep.json by parameter set,
+# and start over when final_age, the tax brackets or SWEEP_CACHE_VERSION change
+# --format csv/json writes the deterministic balance history instead of plotting,
+# --format none just prints, and --timings shows where startup time goes
+
+import time
+_started = time.perf_counter() # for --timings
+
+import argparse
+import csv
+import functools
+import hashlib
+import itertools
+import json
+import os
+import sys
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+# matplotlib is only imported once a plot is asked for, see pyplot()
+_imported = time.perf_counter()
+_pyplot_seconds = None
+
+def pyplot():
+    '''
+    import matplotlib.pyplot on first use, with the non-interactive Agg backend
+    so it never probes for a display. calculation-only runs never pay for it
+    '''
+    global _pyplot_seconds
+    start = time.perf_counter()
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    if _pyplot_seconds is None:
+        _pyplot_seconds = time.perf_counter() - start
+    return plt
 
-import matplotlib.pyplot as plt
 
 # constants we'll use to calculate what our traditional vs roth 401k accounts will look like
 starting_balance = 0
@@ -14,22 +63,28 @@ retirement_age = 65
 annual_retirement_expenses = 125000
 annual_social_security = 15000
 standard_deduction = 15000 # for married couples filing separately
+annual_volatility = 0.15 # standard deviation of yearly returns, for the monte carlo
+final_age = 110
+# the most a year's random return can lose. a -100% year would zero the running growth
+# product that simulate_paths divides by, so draws are floored just above it
+min_annual_return = -0.99
 
 
-def calculate_federal_tax(income):
-    # 2025 tax brackets for Married Filing Separately
-    brackets = [
-        (0, 11925, 0.10),
-        (11925, 48475, 0.12),
-        (48475, 103350, 0.22),
-        (103350, 197300, 0.24),
-        (197300, 250525, 0.32),
-        (250525, 375800, 0.35),
-        (375800, float('inf'), 0.37)
-    ]
+# 2025 tax brackets for Married Filing Separately
+FEDERAL_TAX_BRACKETS = [
+    (0, 11925, 0.10),
+    (11925, 48475, 0.12),
+    (48475, 103350, 0.22),
+    (103350, 197300, 0.24),
+    (197300, 250525, 0.32),
+    (250525, 375800, 0.35),
+    (375800, float('inf'), 0.37)
+]
 
+
+def calculate_federal_tax(income):
     tax = 0.0
-    for lower, upper, rate in brackets:
+    for lower, upper, rate in FEDERAL_TAX_BRACKETS:
         if income > lower:
             taxable_amount = min(income, upper) - lower
             tax += taxable_amount * rate
@@ -37,6 +92,84 @@ def calculate_federal_tax(income):
             break
     return tax
 
+
+def gross_withdrawal_needed_iterative(net_needed, deduction=15000, tolerance=1e-2, max_iter=100):
+    # Estimate gross needed to net a given amount after tax
+    # kept to check gross_withdrawal_needed against, see --bench-tax
+    guess = net_needed
+    for _ in range(max_iter):
+        taxable_income = max(guess - deduction, 0)
+        tax = calculate_federal_tax(taxable_income)
+        net = guess - tax
+        if abs(net - net_needed) < tolerance:
+            return guess, tax
+        guess += (net_needed - net)  # Adjust guess toward target
+    return guess, tax
+
+
+@functools.lru_cache(maxsize=None)
+def inverse_tax_table(deduction):
+    '''
+    net(gross) = gross - tax(max(gross - deduction, 0)) is piecewise linear and increasing,
+    with a kink at the deduction and at every bracket boundary above it.
+    returns (gross_starts, net_starts, rates): where each piece starts, in gross and net terms,
+    and the marginal rate along it
+    '''
+    gross_starts = [0.0]
+    rates = [0.0] # nothing is taxed below the deduction
+    for lower, _, rate in FEDERAL_TAX_BRACKETS:
+        gross_starts.append(deduction + lower)
+        rates.append(rate)
+    net_starts = [g - calculate_federal_tax(max(g - deduction, 0)) for g in gross_starts]
+    return np.array(gross_starts), np.array(net_starts), np.array(rates)
+
+
+def gross_withdrawal_needed(net_needed, deduction=15000):
+    '''
+    gross withdrawal that nets net_needed after federal tax, solved exactly:
+    find the piece of the tax function net_needed lands on, then invert that line.
+    net_needed can be a number or a numpy array. returns (gross, tax)
+    '''
+    gross_starts, net_starts, rates = inverse_tax_table(deduction)
+    net = np.maximum(net_needed, 0)
+    piece = np.searchsorted(net_starts, net, side='right') - 1
+    gross = gross_starts[piece] + (net - net_starts[piece]) / (1 - rates[piece])
+    tax = gross - net
+    if np.ndim(net_needed) == 0:
+        return float(gross), float(tax)
+    return gross, tax
+
+
+def bench_tax(samples=20000, seed=0):
+    '''
+    check the exact solver against the iteration on random and bracket-edge amounts,
+    then time both. returns the largest disagreement in dollars
+    '''
+    rng = np.random.default_rng(seed)
+    edges = [b + standard_deduction for _, b, _ in FEDERAL_TAX_BRACKETS[:-1]]
+    nets = np.concatenate([rng.uniform(0, 1_000_000, samples), edges, [0, standard_deduction]])
+
+    worst = 0.0
+    for net in nets:
+        exact, _ = gross_withdrawal_needed(net, deduction=standard_deduction)
+        # tighter tolerance than the default, so the iteration itself is good to the cent
+        iterated, _ = gross_withdrawal_needed_iterative(net, deduction=standard_deduction, tolerance=1e-4)
+        worst = max(worst, abs(exact - iterated))
+    print(f'{len(nets)} amounts, largest gross difference ${worst:.6f}')
+
+    def timed(label, func, count):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print(f'{label:32} {count / elapsed:14,.0f} solves/s')
+
+    subset = nets[:2000]
+    timed('iterative', lambda: [gross_withdrawal_needed_iterative(n, deduction=standard_deduction) for n in subset], len(subset))
+    timed('exact, one at a time', lambda: [gross_withdrawal_needed(n, deduction=standard_deduction) for n in subset], len(subset))
+    timed('exact, numpy array', lambda: gross_withdrawal_needed(nets, deduction=standard_deduction), len(nets))
+    return worst
+
+
 def sim_401k(
         starting_balance,
         annual_contribution,
@@ -47,22 +180,10 @@ def sim_401k(
         annual_social_security,
         standard_deduction,
 ):
-    def gross_withdrawal_needed(net_needed, deduction=15000, tolerance=1e-2, max_iter=100):
-        # Estimate gross needed to net a given amount after tax
-        guess = net_needed
-        for _ in range(max_iter):
-            taxable_income = max(guess - deduction, 0)
-            tax = calculate_federal_tax(taxable_income)
-            net = guess - tax
-            if abs(net - net_needed) < tolerance:
-                return guess, tax
-            guess += (net_needed - net)  # Adjust guess toward target
-        return guess, tax
-    
     balance = starting_balance
     balance_history = [] # (age, balance, taxes, withdrawals)
 
-    for year in range(age, 110):
+    for year in range(age, final_age):
         balance += annual_contribution if year < retirement_age else 0
         balance *= (1 + annual_growth_rate) # apply before withdrawal
 
@@ -105,7 +226,7 @@ def sim_roth(
     balance = starting_balance
     balance_history = [] # (age, balance, withdrawals)
 
-    for year in range(age, 110):
+    for year in range(age, final_age):
         tax = 0
         if year < retirement_age:
             tax = calculate_federal_tax(annual_salary)
@@ -136,39 +257,428 @@ def sim_roth(
     return balance_history
 
 
-data_401k = sim_401k(starting_balance=starting_balance, 
-                annual_contribution=annual_contributions,
-                annual_growth_rate=annual_growth_rate,
-                age=age,
-                retirement_age=retirement_age,
-                annual_retirement_expenses=annual_retirement_expenses,
-                annual_social_security=annual_social_security,
-                standard_deduction=standard_deduction)
-
-data_roth = sim_roth(starting_balance=starting_balance, 
-                annual_salary=annual_salary,
-                annual_contribution=annual_contributions,
-                annual_growth_rate=annual_growth_rate,
-                age=age,
-                retirement_age=retirement_age,
-                annual_retirement_expenses=annual_retirement_expenses,
-                annual_social_security=annual_social_security)
-
-ages_k, balances_k, withdrawals_k, taxes_k = zip(*data_401k) # unzip
-ages_roth, balances_roth, withdrawals_roth, taxes_roth = zip(*data_roth) # unzip
-
-# pyplot time :)
-plt.figure(figsize=(12, 6))
-plt.plot(ages_k, balances_k, label='401(k) Balance', linewidth=2)
-plt.plot(ages_k, withdrawals_k, label='401(k) withdrawals', linestyle='--')
-plt.plot(ages_k, taxes_k, label='401(k) Tax Paid', linestyle=':')
-plt.plot(ages_roth, balances_roth, label='Roth IRA Balance', linewidth=2)
-plt.plot(ages_roth, withdrawals_roth, label='Roth IRA withdrawals', linestyle='--')
-plt.plot(ages_roth, taxes_roth, label='Roth IRA Tax Paid', linestyle=':')
-plt.title("401(k) vs Roth IRA Balance and withdrawals Over Time")
-plt.xlabel("Age")
-plt.ylabel("Dollars ($)")
-plt.legend()
-plt.grid(True)
-plt.tight_layout()
-plt.savefig('out/401k.png')
+def yearly_cash_flows(
+        annual_salary,
+        annual_contribution,
+        age,
+        retirement_age,
+        annual_retirement_expenses,
+        annual_social_security,
+        standard_deduction,
+):
+    '''
+    contributions and withdrawals for every year from age to final_age, for both accounts
+    these don't depend on market returns, so they're worked out once and shared by every path
+    returns (ages, contrib_401k, withdraw_401k, contrib_roth, withdraw_roth) as arrays
+    '''
+    ages = np.arange(age, final_age)
+    working = ages < retirement_age
+    contrib_401k = np.where(working, annual_contribution, 0.0)
+
+    roth_tax_rate = calculate_federal_tax(annual_salary) / annual_salary
+    contrib_roth = np.where(working, annual_contribution - annual_contribution * roth_tax_rate, 0.0)
+
+    social_security_income = np.where(ages > 65, annual_social_security, 0) # social security age
+    expenses = np.maximum(annual_retirement_expenses - social_security_income, 0)
+    withdraw_roth = np.where(ages > retirement_age, expenses, 0.0)
+    withdraw_401k = np.where(ages > retirement_age, gross_withdrawal_needed(expenses, deduction=standard_deduction)[0], 0.0)
+
+    return ages, contrib_401k, withdraw_401k, contrib_roth, withdraw_roth
+
+
+def draw_returns(rng, n_paths, n_years, model, mean, volatility, historical=None):
+    '''(paths x years) array of yearly returns, none below min_annual_return'''
+    if model == 'normal':
+        returns = rng.normal(mean, volatility, size=(n_paths, n_years))
+    elif model == 'lognormal':
+        # pick the log-space parameters so the arithmetic mean and sd come out as asked
+        sigma = np.sqrt(np.log(1 + volatility ** 2 / (1 + mean) ** 2))
+        mu = np.log(1 + mean) - sigma ** 2 / 2
+        returns = np.expm1(rng.normal(mu, sigma, size=(n_paths, n_years)))
+    elif model == 'bootstrap':
+        returns = rng.choice(np.asarray(historical, dtype=float), size=(n_paths, n_years), replace=True)
+    else:
+        raise ValueError(f'unknown return model {model}')
+    return np.maximum(returns, min_annual_return)
+
+
+def simulate_paths(starting_balance, contributions, withdrawals, returns):
+    '''
+    balances for every path and year, all at once
+    each year is balance = (balance + contribution) * (1 + return) - withdrawal, which unrolls to
+        B_t = G_t * (B_0 + sum over s <= t of (c_s * g_s - w_s) / G_s)
+    with g the yearly growth factor and G its running product, so the whole thing is
+    a cumprod and a cumsum over the years axis. once a path hits zero it stays there
+    returns (balances, depleted_index) where depleted_index is -1 for paths that never ran out
+    '''
+    growth = 1 + returns
+    cum_growth = np.cumprod(growth, axis=1)
+    flows = (contributions * growth - withdrawals) / cum_growth
+    balances = cum_growth * (starting_balance + np.cumsum(flows, axis=1))
+
+    ran_out = balances <= 0
+    depleted = ran_out.any(axis=1)
+    depleted_index = np.where(depleted, ran_out.argmax(axis=1), -1)
+    # zero every year from the first one at or below zero onwards
+    balances[np.maximum.accumulate(ran_out, axis=1)] = 0
+    return balances, depleted_index
+
+
+def load_historical_returns(path):
+    '''one decimal annual return per line, anything that doesn't parse (headers, blanks) is skipped'''
+    returns = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                returns.append(float(line.strip().split(',')[-1]))
+            except ValueError:
+                continue
+    if not returns:
+        raise ValueError(f'no returns found in {path}')
+    return returns
+
+
+def monte_carlo(n_paths, model, volatility, historical=None, seed=None):
+    '''
+    run n_paths random return paths through both accounts
+    returns {'ages': ages, '401k': (balances, depleted_index), 'roth': (balances, depleted_index)}
+    '''
+    ages, contrib_401k, withdraw_401k, contrib_roth, withdraw_roth = yearly_cash_flows(
+        annual_salary=annual_salary,
+        annual_contribution=annual_contributions,
+        age=age,
+        retirement_age=retirement_age,
+        annual_retirement_expenses=annual_retirement_expenses,
+        annual_social_security=annual_social_security,
+        standard_deduction=standard_deduction,
+    )
+    rng = np.random.default_rng(seed)
+    # both accounts see the same market
+    returns = draw_returns(rng, n_paths, len(ages), model, annual_growth_rate, volatility, historical)
+
+    return {
+        'ages': ages,
+        '401k': simulate_paths(starting_balance, contrib_401k, withdraw_401k, returns),
+        'roth': simulate_paths(starting_balance, contrib_roth, withdraw_roth, returns),
+    }
+
+
+def report_monte_carlo(results, percentiles=(10, 50, 90), plot=True):
+    '''print success rates and balance percentiles, and plot the bands'''
+    ages = results['ages']
+    bands = {}
+    for name, label in (('401k', '401(k)'), ('roth', 'Roth IRA')):
+        balances, depleted_index = results[name]
+        success = np.mean(depleted_index < 0)
+        print(f'{label}: {success:.1%} of {len(depleted_index)} paths last to age {final_age}')
+        if (depleted_index >= 0).any():
+            print(f'    median age money runs out when it does: {np.median(ages[depleted_index[depleted_index >= 0]]):.0f}')
+        bands[label] = np.percentile(balances, percentiles, axis=0)
+
+    header = f'{"Age":>5} | ' + ' | '.join(f'{label} p{p:<2}'.rjust(16) for label in bands for p in percentiles)
+    print(header)
+    for i in range(0, len(ages), 5):
+        print(f'{ages[i]:>5} | ' + ' | '.join(f'{bands[label][j][i]:16,.0f}' for label in bands for j in range(len(percentiles))))
+
+    if not plot:
+        return
+    plt = pyplot()
+    plt.figure(figsize=(12, 6))
+    for label, band in bands.items():
+        line, = plt.plot(ages, band[len(percentiles) // 2], label=f'{label} median', linewidth=2)
+        plt.fill_between(ages, band[0], band[-1], color=line.get_color(), alpha=0.2,
+                         label=f'{label} p{percentiles[0]}-p{percentiles[-1]}')
+    plt.title("401(k) vs Roth IRA Balance Over Time, Monte Carlo")
+    plt.xlabel("Age")
+    plt.ylabel("Dollars ($)")
+    plt.legend()
+    plt.grid(True)
+    plt.tight_layout()
+    plt.savefig('out/401k_monte_carlo.png')
+
+
+# parameters --sweep can vary, all default to the constants above
+SWEEP_PARAMETERS = [
+    'starting_balance',
+    'annual_salary',
+    'annual_contributions',
+    'annual_growth_rate',
+    'age',
+    'retirement_age',
+    'annual_retirement_expenses',
+    'annual_social_security',
+    'standard_deduction',
+]
+# years count whole, the simulations step through them with range()
+INTEGER_SWEEP_PARAMETERS = ['age', 'retirement_age']
+SWEEP_CACHE_PATH = os.path.expanduser('~/.cache/401k_sweep.json')
+# bump when the simulation itself changes, so cached sweep results aren't reused
+SWEEP_CACHE_VERSION = 1
+
+
+def default_parameters():
+    return {name: globals()[name] for name in SWEEP_PARAMETERS}
+
+
+def run_scenario(params):
+    '''
+    run both deterministic sims for one set of parameters (a tuple of (name, value) pairs)
+    returns (age the 401(k) runs out, age the roth runs out), None if it lasts to final_age
+    '''
+    p = dict(params)
+    data_401k = sim_401k(
+        starting_balance=p['starting_balance'],
+        annual_contribution=p['annual_contributions'],
+        annual_growth_rate=p['annual_growth_rate'],
+        age=p['age'],
+        retirement_age=p['retirement_age'],
+        annual_retirement_expenses=p['annual_retirement_expenses'],
+        annual_social_security=p['annual_social_security'],
+        standard_deduction=p['standard_deduction'],
+    )
+    data_roth = sim_roth(
+        starting_balance=p['starting_balance'],
+        annual_salary=p['annual_salary'],
+        annual_contribution=p['annual_contributions'],
+        annual_growth_rate=p['annual_growth_rate'],
+        age=p['age'],
+        retirement_age=p['retirement_age'],
+        annual_retirement_expenses=p['annual_retirement_expenses'],
+        annual_social_security=p['annual_social_security'],
+    )
+
+    def runs_out(history):
+        year, balance = history[-1][:2]
+        return year if balance <= 0 else None
+
+    return runs_out(data_401k), runs_out(data_roth)
+
+
+def parse_sweep(spec):
+    '''turn name=start:stop:step (stop included) into (name, [values])'''
+    name, _, values = spec.partition('=')
+    if name not in SWEEP_PARAMETERS:
+        raise ValueError(f'can only sweep {", ".join(SWEEP_PARAMETERS)}')
+    start, stop, step = (float(v) for v in values.split(':'))
+    if step <= 0:
+        raise ValueError(f'{name} step must be positive, not {step:g}')
+    as_int = all(float(v).is_integer() for v in (start, stop, step))
+    if name in INTEGER_SWEEP_PARAMETERS and not as_int:
+        raise ValueError(f'{name} can only be swept over whole numbers')
+    points = np.arange(start, stop + step / 2, step)
+    return name, [int(v) if as_int else round(float(v), 10) for v in points]
+
+
+def sweep_model_key():
+    '''
+    what sweep results depend on besides the swept parameters. cached results are kept
+    under it, so changing any of these starts the cache over
+    '''
+    brackets = hashlib.sha1(repr(FEDERAL_TAX_BRACKETS).encode()).hexdigest()[:12]
+    return f'v{SWEEP_CACHE_VERSION} final_age={final_age} brackets={brackets}'
+
+
+def load_sweep_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_sweep_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def sweep(axes, workers=None, cache_path=SWEEP_CACHE_PATH):
+    '''
+    run every combination of the swept values across a process pool
+    each scenario is memoised on disk keyed by its full parameter tuple (under sweep_model_key()),
+    so rerunning an overlapping grid only computes the new points
+    returns {tuple of swept values: (age 401(k) runs out, age roth runs out)}
+    '''
+    names = [name for name, _ in axes]
+    grid = list(itertools.product(*(values for _, values in axes)))
+    base = default_parameters()
+    scenarios = [tuple(sorted({**base, **dict(zip(names, point))}.items())) for point in grid]
+
+    # results from another tax table, final age or version of the simulation are dropped
+    model = sweep_model_key()
+    cache = load_sweep_cache(cache_path).get(model, {})
+    keys = [json.dumps(scenario) for scenario in scenarios]
+    todo = [scenario for scenario, key in zip(scenarios, keys) if key not in cache]
+    print(f'{len(grid)} scenarios, {len(grid) - len(todo)} cached, running {len(todo)}')
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(todo) // ((workers or os.cpu_count()) * 4))
+            for scenario, result in zip(todo, pool.map(run_scenario, todo, chunksize=chunksize)):
+                cache[json.dumps(scenario)] = result
+        save_sweep_cache(cache_path, {model: cache})
+
+    return {point: tuple(cache[key]) for point, key in zip(grid, keys)}
+
+
+def report_sweep(axes, results, plot=True):
+    '''table of when each account runs out, and a heatmap when two parameters are swept'''
+    def fmt(value):
+        return f'{value}' if value is not None else f'{final_age}+'
+
+    names = [name for name, _ in axes]
+    if len(axes) != 2:
+        print(' | '.join(f'{n:>26}' for n in names) + f' | {"401(k) runs out":>15} | {"Roth runs out":>15}')
+        for point, (age_k, age_roth) in results.items():
+            print(' | '.join(f'{v:>26}' for v in point) + f' | {fmt(age_k):>15} | {fmt(age_roth):>15}')
+        return
+
+    (row_name, row_values), (col_name, col_values) = axes
+    for index, label in ((0, '401(k)'), (1, 'Roth IRA')):
+        print(f'\n{label}: age money runs out, {row_name} down, {col_name} across')
+        print(f'{"":>12} ' + ' '.join(f'{v:>8}' for v in col_values))
+        for r in row_values:
+            print(f'{r:>12} ' + ' '.join(f'{fmt(results[(r, c)][index]):>8}' for c in col_values))
+
+    if not plot:
+        return
+    plt = pyplot()
+    fig, subplots = plt.subplots(1, 2, figsize=(14, 6), sharey=True)
+    for index, (ax, label) in enumerate(zip(subplots, ('401(k)', 'Roth IRA'))):
+        grid = np.array([[results[(r, c)][index] or final_age for c in col_values] for r in row_values])
+        image = ax.imshow(grid, origin='lower', aspect='auto', cmap='RdYlGn', vmin=retirement_age, vmax=final_age,
+                          extent=(col_values[0], col_values[-1], row_values[0], row_values[-1]))
+        ax.set_title(f'{label}: age money runs out')
+        ax.set_xlabel(col_name)
+    subplots[0].set_ylabel(row_name)
+    fig.colorbar(image, ax=subplots, label='Age')
+    plt.savefig('out/401k_sweep.png')
+
+
+def run_deterministic():
+    '''one path at annual_growth_rate for each account, returns (data_401k, data_roth)'''
+    data_401k = sim_401k(starting_balance=starting_balance, 
+                    annual_contribution=annual_contributions,
+                    annual_growth_rate=annual_growth_rate,
+                    age=age,
+                    retirement_age=retirement_age,
+                    annual_retirement_expenses=annual_retirement_expenses,
+                    annual_social_security=annual_social_security,
+                    standard_deduction=standard_deduction)
+
+    data_roth = sim_roth(starting_balance=starting_balance, 
+                    annual_salary=annual_salary,
+                    annual_contribution=annual_contributions,
+                    annual_growth_rate=annual_growth_rate,
+                    age=age,
+                    retirement_age=retirement_age,
+                    annual_retirement_expenses=annual_retirement_expenses,
+                    annual_social_security=annual_social_security)
+
+    return data_401k, data_roth
+
+
+def write_balance_history(data_401k, data_roth, fmt, path):
+    '''write both balance histories as csv or json, for batch use without matplotlib'''
+    fields = ('age', 'balance', 'withdrawal', 'tax')
+    rows = [
+        {'account': account, **dict(zip(fields, entry))}
+        for account, data in (('401k', data_401k), ('roth', data_roth))
+        for entry in data
+    ]
+    with open(path, 'w', newline='') as f:
+        if fmt == 'json':
+            json.dump(rows, f, indent=1)
+        else:
+            writer = csv.DictWriter(f, fieldnames=('account',) + fields)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def plot_deterministic(data_401k, data_roth):
+    ages_k, balances_k, withdrawals_k, taxes_k = zip(*data_401k) # unzip
+    ages_roth, balances_roth, withdrawals_roth, taxes_roth = zip(*data_roth) # unzip
+
+    # pyplot time :)
+    plt = pyplot()
+    plt.figure(figsize=(12, 6))
+    plt.plot(ages_k, balances_k, label='401(k) Balance', linewidth=2)
+    plt.plot(ages_k, withdrawals_k, label='401(k) withdrawals', linestyle='--')
+    plt.plot(ages_k, taxes_k, label='401(k) Tax Paid', linestyle=':')
+    plt.plot(ages_roth, balances_roth, label='Roth IRA Balance', linewidth=2)
+    plt.plot(ages_roth, withdrawals_roth, label='Roth IRA withdrawals', linestyle='--')
+    plt.plot(ages_roth, taxes_roth, label='Roth IRA Tax Paid', linestyle=':')
+    plt.title("401(k) vs Roth IRA Balance and withdrawals Over Time")
+    plt.xlabel("Age")
+    plt.ylabel("Dollars ($)")
+    plt.legend()
+    plt.grid(True)
+    plt.tight_layout()
+    plt.savefig('out/401k.png')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare a traditional 401(k) against a roth over retirement')
+    parser.add_argument('--paths', type=int, default=0, help='run a monte carlo with this many return paths')
+    parser.add_argument('--returns', choices=['normal', 'lognormal', 'bootstrap'], default='lognormal',
+                        help='how yearly returns are drawn (default lognormal)')
+    parser.add_argument('--volatility', type=float, default=annual_volatility,
+                        help=f'standard deviation of yearly returns (default {annual_volatility})')
+    parser.add_argument('--returns-file', help='historical annual returns to bootstrap from')
+    parser.add_argument('--seed', type=int, help='random seed, for repeatable runs')
+    parser.add_argument('--bench-tax', action='store_true',
+                        help='check the exact withdrawal solver against the old iteration and time both')
+    parser.add_argument('--sweep', action='append', metavar='NAME=START:STOP:STEP',
+                        help=f'sweep a parameter over a range, can be repeated. one of {", ".join(SWEEP_PARAMETERS)}')
+    parser.add_argument('--workers', type=int, help='processes for --sweep (default one per cpu)')
+    parser.add_argument('--format', choices=['png', 'csv', 'json', 'none'], default='png',
+                        help='png plots into out/ (default). csv and json write the deterministic balance history '
+                             'to out/401k.csv or out/401k.json, and like none skip matplotlib entirely')
+    parser.add_argument('--timings', action='store_true', help='print import and end to end timings to stderr')
+    args = parser.parse_args()
+    plot = args.format == 'png'
+
+    try:
+        run(parser, args, plot)
+    finally:
+        if args.timings:
+            pyplot_ms = f'{_pyplot_seconds * 1000:.0f} ms' if _pyplot_seconds is not None else 'not loaded'
+            print(f'import {(_imported - _started) * 1000:.0f} ms, matplotlib {pyplot_ms}, '
+                  f'end to end {(time.perf_counter() - _started) * 1000:.0f} ms', file=sys.stderr)
+
+
+def run(parser, args, plot):
+    if args.sweep:
+        try:
+            axes = [parse_sweep(spec) for spec in args.sweep]
+        except ValueError as e:
+            parser.error(f'--sweep: {e}')
+        report_sweep(axes, sweep(axes, args.workers), plot)
+        return
+
+    if args.bench_tax:
+        # anything over a cent means the solvers disagree
+        sys.exit(0 if bench_tax() < 0.01 else 1)
+
+    if not args.paths:
+        data_401k, data_roth = run_deterministic()
+        if plot:
+            plot_deterministic(data_401k, data_roth)
+        elif args.format != 'none':
+            write_balance_history(data_401k, data_roth, args.format, f'out/401k.{args.format}')
+        return
+
+    historical = None
+    if args.returns == 'bootstrap':
+        if not args.returns_file:
+            parser.error('--returns bootstrap needs --returns-file')
+        historical = load_historical_returns(args.returns_file)
+
+    results = monte_carlo(args.paths, args.returns, args.volatility, historical, args.seed)
+    report_monte_carlo(results, plot=plot)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 #!/bin/bash
 
 # extract all magnet links and torrent names from qbittorrent flatpak configs
+# the torrents are read by extract_magnets.py, which only re-reads ones that changed
 
 BT_BACKUP="$HOME/.var/app/org.qbittorrent.qBittorrent/data/qBittorrent/BT_backup"
 
@@ -9,8 +10,4 @@ if [ ! -d "$BT_BACKUP" ]; then
     exit 1
 fi
 
-for TORRENT in "$BT_BACKUP"/*.torrent; do
-    TORRENT_NAME=$(transmission-show "$TORRENT" | awk -F': ' '/Name/ {print $2}')
-    MAGNET=$(transmission-show -m "$TORRENT")
-    echo "$TORRENT_NAME | $MAGNET"
-done
+exec python3 "$(dirname "$0")/extract_magnets.py" "$BT_BACKUP" "$@"
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+'''
+extract magnet links and torrent names from qbittorrent's BT_backup folder
+
+./extract_magnets.py [BT_BACKUP] prints "name | magnet" lines like extract-magnets.sh
+always has, or one json object per torrent with --format jsonl
+
+torrents are decoded in-process rather than with transmission-show. the info hash is
+the sha1 of the info dict exactly as it appears in the file, so it matches what clients
+compute even for torrents that aren't canonically encoded.
+
+what was read is kept in ~/.cache/magnets.db keyed by path, so only torrents whose
+mtime or size changed since the last run are read again. pass --full-rescan to ignore
+it. when there are enough of them they are decoded on --workers processes
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+
+BT_BACKUP = os.path.expanduser('~/.var/app/org.qbittorrent.qBittorrent/data/qBittorrent/BT_backup')
+CATALOGUE_PATH = os.path.expanduser('~/.cache/magnets.db')
+
+# below this many changed torrents, starting worker processes costs more than it saves
+PARALLEL_THRESHOLD = 64
+
+
+class BencodeError(ValueError):
+    pass
+
+
+def decode_value(data:bytes, i:int):
+    '''decode the bencoded value starting at data[i], returns (value, index just past it)'''
+    try:
+        kind = data[i]
+    except IndexError:
+        raise BencodeError(f'truncated at byte {i}') from None
+
+    if kind == 0x64: # d
+        result = {}
+        i += 1
+        while data[i] != 0x65: # e
+            key, i = decode_value(data, i)
+            if not isinstance(key, bytes):
+                raise BencodeError(f'non-string dict key at byte {i}')
+            result[key], i = decode_value(data, i)
+        return result, i + 1
+
+    if kind == 0x6c: # l
+        result = []
+        i += 1
+        while data[i] != 0x65:
+            value, i = decode_value(data, i)
+            result.append(value)
+        return result, i + 1
+
+    if kind == 0x69: # i
+        end = data.index(b'e', i)
+        return int(data[i + 1:end]), end + 1
+
+    if 0x30 <= kind <= 0x39: # string, <length>:<bytes>
+        colon = data.index(b':', i)
+        start = colon + 1
+        end = start + int(data[i:colon])
+        if end > len(data):
+            raise BencodeError(f'string at byte {i} runs past the end')
+        return data[start:end], end
+
+    raise BencodeError(f'unexpected {chr(kind)!r} at byte {i}')
+
+
+def decode_torrent(data:bytes) -> tuple[dict, bytes]:
+    '''
+    decode the top level dict of a .torrent and return (metainfo, raw bencoded info dict)
+    the raw info dict is what the info hash is taken over
+    '''
+    if data[:1] != b'd':
+        raise BencodeError('not a bencoded dict')
+    metainfo = {}
+    raw_info = None
+    i = 1
+    try:
+        while data[i] != 0x65:
+            key, i = decode_value(data, i)
+            start = i
+            metainfo[key], i = decode_value(data, i)
+            if key == b'info':
+                raw_info = data[start:i]
+    except (IndexError, ValueError, RecursionError) as e:
+        raise BencodeError(str(e) or type(e).__name__) from None
+    if raw_info is None or not isinstance(metainfo[b'info'], dict):
+        raise BencodeError('no info dict')
+    return metainfo, raw_info
+
+
+def magnet_link(info_hash:str, name:str) -> str:
+    '''same shape as the links in magnet_links.txt'''
+    return f'magnet:?xt=urn:btih:{info_hash}&dn={quote(name, safe="")}'
+
+
+def read_torrent(path:str) -> dict:
+    '''
+    read one .torrent and return its catalogue fields
+    a torrent that can't be read comes back with error set, so it isn't retried until it changes
+    '''
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        metainfo, raw_info = decode_torrent(data)
+    except (OSError, BencodeError) as e:
+        return {'path': path, 'info_hash': None, 'name': None, 'length': None, 'error': str(e)}
+
+    info = metainfo[b'info']
+    name = info.get(b'name.utf-8', info.get(b'name', b''))
+    name = name.decode('utf-8', 'replace') if isinstance(name, bytes) else str(name)
+    if b'length' in info:
+        length = info[b'length']
+    else:
+        length = sum(f.get(b'length', 0) for f in info.get(b'files', []) if isinstance(f, dict))
+    return {
+        'path': path,
+        'info_hash': hashlib.sha1(raw_info).hexdigest(),
+        'name': name,
+        'length': length,
+        'error': None,
+    }
+
+
+def open_catalogue(path:str) -> sqlite3.Connection:
+    '''open the sqlite catalogue, creating it if needed'''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS torrents (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            info_hash TEXT,
+            name TEXT,
+            length INTEGER,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS torrents_info_hash ON torrents (info_hash);
+    ''')
+    return conn
+
+
+def catalogue_rows(conn:sqlite3.Connection, backup_dir:str, columns:str):
+    '''rows for the torrents in backup_dir, the catalogue can hold more than one folder'''
+    backup_dir = os.path.abspath(backup_dir)
+    for row in conn.execute(f'SELECT path, {columns} FROM torrents ORDER BY path'):
+        if os.path.dirname(row[0]) == backup_dir:
+            yield row
+
+
+def update_catalogue(conn:sqlite3.Connection, backup_dir:str, workers:int=None, full_rescan:bool=False) -> dict:
+    '''
+    bring the catalogue in line with the .torrent files in backup_dir
+    returns counts of torrents seen, read and removed
+    '''
+    backup_dir = os.path.abspath(backup_dir)
+    current = {}
+    with os.scandir(backup_dir) as it:
+        for entry in it:
+            if entry.name.endswith('.torrent') and entry.is_file():
+                st = entry.stat()
+                current[entry.path] = (st.st_mtime_ns, st.st_size)
+
+    known = {path: (mtime_ns, size) for path, mtime_ns, size in catalogue_rows(conn, backup_dir, 'mtime_ns, size')}
+    changed = sorted(path for path, stamp in current.items() if full_rescan or known.get(path) != stamp)
+    removed = [path for path in known if path not in current]
+
+    if len(changed) >= PARALLEL_THRESHOLD and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(changed) // ((workers or os.cpu_count()) * 4))
+            results = pool.map(read_torrent, changed, chunksize=chunksize)
+            write_results(conn, results, current)
+    else:
+        write_results(conn, map(read_torrent, changed), current)
+
+    conn.executemany('DELETE FROM torrents WHERE path = ?', [(path,) for path in removed])
+    conn.commit()
+    return {'torrents': len(current), 'read': len(changed), 'removed': len(removed)}
+
+
+def write_results(conn:sqlite3.Connection, results, current:dict) -> None:
+    '''store results as they come in, committing every so often so an interrupted run keeps its work'''
+    for n, result in enumerate(results, 1):
+        mtime_ns, size = current[result['path']]
+        conn.execute(
+            'INSERT OR REPLACE INTO torrents (path, mtime_ns, size, info_hash, name, length, error) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (result['path'], mtime_ns, size, result['info_hash'], result['name'], result['length'], result['error']),
+        )
+        if n % 1000 == 0:
+            conn.commit()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='list the magnet links of the torrents in a qbittorrent BT_backup folder')
+    parser.add_argument('backup_dir', nargs='?', default=BT_BACKUP, help='default %(default)s')
+    parser.add_argument('--db', default=CATALOGUE_PATH, help='catalogue database (default %(default)s)')
+    parser.add_argument('--format', choices=['lines', 'jsonl'], default='lines', help='"name | magnet" lines, or one json object per torrent')
+    parser.add_argument('--workers', type=int, default=None, help='processes to decode with (default one per cpu)')
+    parser.add_argument('--full-rescan', action='store_true', help='read every torrent again')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.backup_dir):
+        print(f'BT backup folder not found at {args.backup_dir}', file=sys.stderr)
+        sys.exit(1)
+
+    start = time.perf_counter()
+    conn = open_catalogue(args.db)
+    counts = update_catalogue(conn, args.backup_dir, args.workers, args.full_rescan)
+
+    errors = 0
+    for path, info_hash, name, length, error in catalogue_rows(conn, args.backup_dir, 'info_hash, name, length, error'):
+        if error:
+            errors += 1
+            print(f'{os.path.basename(path)}: {error}', file=sys.stderr)
+            continue
+        magnet = magnet_link(info_hash, name)
+        if args.format == 'jsonl':
+            print(json.dumps({'name': name, 'info_hash': info_hash, 'length': length, 'magnet': magnet, 'path': path}))
+        else:
+            print(f'{name} | {magnet}')
+    conn.close()
+
+    print(f'{counts["torrents"]} torrents, {counts["read"]} read, {counts["removed"]} removed, {errors} unreadable '
+          f'in {time.perf_counter() - start:.2f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
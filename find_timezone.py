@@ -6,61 +6,326 @@
 # will spit out the location1 timezone at that datetime
 # the home timezone at that datetime
 # and the corresponding home time to put in your calendar
+#
+# looked up locations are cached in ~/.cache/find_timezone.json for CACHE_TTL_DAYS,
+# so repeat lookups don't touch the network. if geocoding fails, an expired cache
+# entry is used rather than giving up, so cities you've looked up before work offline
+#
+# ./find_timezone.py --batch itinerary.csv converts a whole itinerary in one go.
+# the file is csv with a location1,location2,date,time header, or a json list of
+# objects with those keys. each distinct location is geocoded once, and converted
+# rows stream out as csv. local times that happen twice (clocks going back) or
+# never (clocks going forward) are flagged in the note column
+#
+# geopy and timezonefinder are slow to import, so they are only imported on the
+# paths that geocode. ./find_timezone.py --bench-startup checks the cold start of
+# --help with python -X importtime against STARTUP_TARGET_MS
+#
+# ./find_timezone.py --check runs the lookup, cache and batch paths against a
+# stand-in geocoder (StandInGeocoder), so they can be checked offline
 
+import csv
+import io
+import json
 import os
+import subprocess
 import sys
-import pytz
+import time
+
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+
+CACHE_PATH = os.path.expanduser('~/.cache/find_timezone.json')
+CACHE_TTL_DAYS = 180
+
+# loading the timezone polygons is the slow part, so there is only ever one of these
+_timezone_finder = None
+
+STARTUP_TARGET_MS = 100
+
+BATCH_FIELDS = ['location1', 'timezone1', 'datetime1', 'location2', 'timezone2', 'datetime2', 'note']
+
+
+class LocationError(Exception):
+    pass
 
-from datetime import datetime
-from geopy.geocoders import Nominatim
-from timezonefinder import TimezoneFinder
 
 def print_help() -> None:
     rel = os.path.relpath(__file__, os.getcwd())
     print(f'{rel} - convert a local time at location1 to the corresponding time at location2')
     print(f'Usage:')
     print(f'    {rel} "<location1>" "<location2>" YYYY-MM-DD HH:MM')
+    print(f'    {rel} --batch <itinerary.csv|itinerary.json>')
+    print(f'    {rel} --bench-startup')
+    print(f'    {rel} --check')
     print()
 
     sys.exit(0)
 
 
-def check_location(location: str):
-    geolocator = Nominatim(user_agent="timezone_converter")
-    loc = geolocator.geocode(location)
+def load_cache(path: str) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path: str, cache: dict) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def check_location(location: str, cache: dict = None, geocoder=None):
+    '''
+    returns ((latitude, longitude), timezone name) for a location string
+    a fresh cache entry is used as is. otherwise the location is geocoded and the cache
+    updated, falling back to a stale entry if the geocoder can't be reached.
+    geocoder is anything with geopy's geocode(), so a local stand-in can replace Nominatim
+    raises LocationError if the location can't be resolved
+    '''
+    key = location.strip().lower()
+    entry = cache.get(key) if cache is not None else None
+    if entry and time.time() - entry['fetched'] < CACHE_TTL_DAYS * 24 * 60 * 60:
+        return (entry['lat'], entry['lon']), entry['tz']
+
+    from geopy.exc import GeopyError
+    if geocoder is None:
+        from geopy.geocoders import Nominatim
+        geocoder = Nominatim(user_agent="timezone_converter")
+    try:
+        loc = geocoder.geocode(location)
+    except GeopyError as e:
+        if entry:
+            print(f'Warning: could not geocode {location} ({e}), using cached result', file=sys.stderr)
+            return (entry['lat'], entry['lon']), entry['tz']
+        raise LocationError(f'could not geocode {location}: {e}')
+
     if not loc:
-        print(f'Error: could not find location {location}')
-        sys.exit(1)
+        raise LocationError(f'could not find location {location}')
 
     tz = get_timezone(loc.latitude, loc.longitude)
     if not tz:
-        print(f'Error: could not determine timezone for {location}')
-        sys.exit(1)
+        raise LocationError(f'could not determine timezone for {location}')
 
-    return loc, tz
+    if cache is not None:
+        cache[key] = {'lat': loc.latitude, 'lon': loc.longitude, 'tz': tz, 'fetched': time.time()}
+    return (loc.latitude, loc.longitude), tz
         
 
 def get_timezone(lat, lon):
-    tf = TimezoneFinder()
-    return tf.timezone_at(lat=lat, lng=lon)
+    global _timezone_finder
+    if _timezone_finder is None:
+        from timezonefinder import TimezoneFinder
+        _timezone_finder = TimezoneFinder(in_memory=True)
+    return _timezone_finder.timezone_at(lat=lat, lng=lon)
+
+
+def localize(dt, tz_name):
+    '''
+    attach tz_name to a naive local datetime, returns (aware datetime, note)
+    note flags local times that are ambiguous or don't exist because of a DST change,
+    in which case the standard time reading is used
+    '''
+    tz = ZoneInfo(tz_name)
+    earlier = dt.replace(tzinfo=tz, fold=0)
+    later = dt.replace(tzinfo=tz, fold=1)
+    if earlier.utcoffset() == later.utcoffset():
+        return earlier, ''
+
+    # the offsets differ, so the time is either in a gap or in an overlap.
+    # a time in a gap doesn't survive a round trip through utc
+    normalized = earlier.astimezone(timezone.utc).astimezone(tz)
+    if normalized.replace(tzinfo=None) != dt:
+        return normalized, f'does not exist in {tz_name}, clocks skip it'
+    # in an overlap the second occurrence is the one back on standard time
+    return later, f'ambiguous in {tz_name}, happens twice, used standard time'
+
+
+def convert(tz1, tz2, date_str, time_str):
+    '''
+    convert a local date and time at tz1 to tz2, returns (dt1, dt2, note)
+    raises ValueError for a badly formatted date or time
+    '''
+    dt = datetime.strptime(f'{date_str} {time_str}', '%Y-%m-%d %H:%M')
+    dt1, note = localize(dt, tz1)
+    dt2 = dt1.astimezone(ZoneInfo(tz2))
+    return dt1, dt2, note
 
 
 def convert_and_print(location1, tz1, location2, tz2, date_str, time_str):
     # parse base datetime
     try:
-        dt = datetime.strptime(f'{date_str} {time_str}', '%Y-%m-%d %H:%M')
+        dt1, dt2, note = convert(tz1, tz2, date_str, time_str)
     except ValueError:
         print(f'Error: date must be YYYY-MM-DD and time must be HH:MM. Provided date {date_str} and time {time_str}')
         sys.exit(1)
 
-    local_tz1 = pytz.timezone(tz1)
-    dt1 = local_tz1.localize(dt)
-    local_tz2 = pytz.timezone(tz2)
-    dt2 = dt1.astimezone(local_tz2)
-
     print(f'{"Location":30} | {"Timezone":20} | Datetime')
     print(f'{location1:30} | {tz1:20} | {dt1}')
     print(f'{location2:30} | {tz2:20} | {dt2}')
+    if note:
+        print(f'Note: {location1} {date_str} {time_str} is {note}')
+
+
+def read_itinerary(path):
+    '''rows of location1, location2, date, time from a csv (with header) or json file'''
+    with open(path, 'r', newline='') as f:
+        if path.endswith('.json'):
+            return json.load(f)
+        return list(csv.DictReader(f))
+
+
+def convert_batch(rows, cache, out, geocoder=None):
+    '''
+    convert every itinerary row and write csv to out as each one is done
+    distinct locations are geocoded once, up front, and a bad row only
+    gets a note instead of stopping the batch
+    '''
+    if geocoder is None:
+        from geopy.extra.rate_limiter import RateLimiter
+        from geopy.geocoders import Nominatim
+        # nominatim asks for at most one request a second
+        nominatim = Nominatim(user_agent="timezone_converter")
+        geocoder = SimpleNamespace(geocode=RateLimiter(nominatim.geocode, min_delay_seconds=1, swallow_exceptions=False))
+
+    timezones = {}
+    for location in dict.fromkeys(row[key] for row in rows for key in ('location1', 'location2')):
+        try:
+            timezones[location] = check_location(location, cache, geocoder)[1]
+        except LocationError as e:
+            timezones[location] = e
+
+    writer = csv.DictWriter(out, fieldnames=BATCH_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        tz1, tz2 = timezones[row['location1']], timezones[row['location2']]
+        result = {'location1': row['location1'], 'location2': row['location2']}
+        if isinstance(tz1, LocationError) or isinstance(tz2, LocationError):
+            result['note'] = str(tz1 if isinstance(tz1, LocationError) else tz2)
+        else:
+            result.update(timezone1=tz1, timezone2=tz2)
+            try:
+                dt1, dt2, result['note'] = convert(tz1, tz2, row['date'], row['time'])
+                result.update(datetime1=dt1.isoformat(), datetime2=dt2.isoformat())
+            except ValueError:
+                result['note'] = f'bad date {row["date"]} or time {row["time"]}, need YYYY-MM-DD and HH:MM'
+        writer.writerow(result)
+        out.flush()
+
+
+class StandInGeocoder:
+    '''
+    answers geocode() from a fixed table instead of Nominatim, and counts the calls
+    unknown places come back as None, like geopy does. with fail set every call raises
+    '''
+    PLACES = {
+        'paris': (48.8566, 2.3522),
+        'sydney': (-33.8688, 151.2093),
+        'new york': (40.7128, -74.0060),
+    }
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = 0
+
+    def geocode(self, location):
+        from geopy.exc import GeocoderUnavailable
+        self.calls += 1
+        if self.fail:
+            raise GeocoderUnavailable('stand-in geocoder is down')
+        coords = self.PLACES.get(location.strip().lower())
+        return SimpleNamespace(latitude=coords[0], longitude=coords[1]) if coords else None
+
+
+def self_check():
+    '''run check_location and convert_batch against StandInGeocoder, prints each check and returns whether all passed'''
+    results = []
+
+    def check(name, passed):
+        results.append(passed)
+        print(f'{"ok" if passed else "FAILED":6} {name}')
+
+    def raises_location_error(func, *args):
+        try:
+            func(*args)
+        except LocationError:
+            return True
+        return False
+
+    cache = {}
+    geocoder = StandInGeocoder()
+    check('a new location is geocoded', check_location('Paris', cache, geocoder)[1] == 'Europe/Paris' and geocoder.calls == 1)
+    check('a cached location is not geocoded again', check_location(' paris ', cache, geocoder)[1] == 'Europe/Paris' and geocoder.calls == 1)
+
+    cache['paris']['fetched'] -= (CACHE_TTL_DAYS + 1) * 24 * 60 * 60
+    check('a stale entry is used when the geocoder is down', check_location('Paris', cache, StandInGeocoder(fail=True))[1] == 'Europe/Paris')
+    check('a stale entry is refreshed otherwise', check_location('Paris', cache, geocoder)[1] == 'Europe/Paris' and geocoder.calls == 2)
+    check('an unknown place raises LocationError', raises_location_error(check_location, 'Atlantis', {}, geocoder))
+    check('the geocoder being down with nothing cached raises LocationError',
+          raises_location_error(check_location, 'Sydney', {}, StandInGeocoder(fail=True)))
+
+    rows = [
+        {'location1': 'Paris', 'location2': 'New York', 'date': '2025-03-30', 'time': '02:30'},
+        {'location1': 'Paris', 'location2': 'New York', 'date': '2025-10-26', 'time': '02:30'},
+        {'location1': 'Sydney', 'location2': 'Paris', 'date': '2025-07-01', 'time': '09:00'},
+        {'location1': 'Atlantis', 'location2': 'Paris', 'date': '2025-07-01', 'time': '09:00'},
+        {'location1': 'Sydney', 'location2': 'Paris', 'date': '2025-07-01', 'time': '9am'},
+    ]
+    geocoder = StandInGeocoder()
+    out = io.StringIO()
+    convert_batch(rows, {}, out, geocoder)
+    converted = list(csv.DictReader(io.StringIO(out.getvalue())))
+    check('a batch geocodes each distinct location once', geocoder.calls == 4)
+    check('a batch writes one row per itinerary row', len(converted) == len(rows))
+    check('a time in the spring forward gap is flagged',
+          converted[0]['datetime1'] == '2025-03-30T03:30:00+02:00' and 'does not exist' in converted[0]['note'])
+    check('a time in the fall back overlap is flagged',
+          converted[1]['datetime1'] == '2025-10-26T02:30:00+01:00' and 'ambiguous' in converted[1]['note'])
+    check('a plain row converts', converted[2]['datetime2'] == '2025-07-01T01:00:00+02:00' and not converted[2]['note'])
+    check('a row with an unknown place gets a note', 'could not find location Atlantis' in converted[3]['note'])
+    check('a row with a bad time gets a note', converted[4]['note'].startswith('bad date'))
+
+    print(f'{sum(results)} of {len(results)} checks passed')
+    return all(results)
+
+
+def bench_startup(runs=5):
+    '''
+    time a cold `--help` with python -X importtime, best of a few runs
+    prints the slowest imports and returns whether it's under STARTUP_TARGET_MS
+    '''
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--help'],
+            capture_output=True, text=True,
+        )
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if best is None or elapsed_ms < best[0]:
+            best = (elapsed_ms, result.stderr)
+
+    elapsed_ms, importtime = best
+    # lines look like: import time:  self [us] | cumulative | imported package
+    imports = []
+    for line in importtime.splitlines():
+        parts = line.removeprefix('import time:').split('|')
+        if len(parts) == 3 and parts[0].strip().isdigit():
+            imports.append((int(parts[1]), int(parts[0]), parts[2].rstrip()))
+    import_ms = sum(self_us for _, self_us, _ in imports) / 1000
+
+    print(f'--help cold start {elapsed_ms:.0f} ms, of which imports {import_ms:.0f} ms (target {STARTUP_TARGET_MS} ms)')
+    print('slowest top level imports (cumulative):')
+    top_level = [i for i in imports if not i[2].startswith('  ')]
+    for cumulative_us, _, name in sorted(top_level, reverse=True)[:5]:
+        print(f'    {cumulative_us / 1000:8.1f} ms  {name.strip()}')
+    return elapsed_ms <= STARTUP_TARGET_MS
 
 
 if __name__ == '__main__':
@@ -68,15 +333,39 @@ if __name__ == '__main__':
     if not args or '-h' in args or '--help' in args:
         print_help()
 
+    if args[0] == '--bench-startup':
+        sys.exit(0 if bench_startup() else 1)
+
+    if args[0] == '--check':
+        sys.exit(0 if self_check() else 1)
+
+    cache = load_cache(CACHE_PATH)
+
+    if args[0] == '--batch':
+        if len(args) < 2:
+            print(f'Error: --batch needs an itinerary file')
+            print_help()
+        try:
+            convert_batch(read_itinerary(args[1]), cache, sys.stdout)
+        finally:
+            save_cache(CACHE_PATH, cache)
+        sys.exit(0)
+
     if len(args) < 4:
         print(f'Error: not enough arguments')
         print_help()
 
-    location1 = args[0]
-    loc1_obj, tz1 = check_location(location1)
+    try:
+        location1 = args[0]
+        loc1_coords, tz1 = check_location(location1, cache)
+
+        location2 = args[1]
+        loc2_coords, tz2 = check_location(location2, cache)
+    except LocationError as e:
+        print(f'Error: {e}')
+        sys.exit(1)
 
-    location2 = args[1]
-    loc2_obj, tz2 = check_location(location2)
+    save_cache(CACHE_PATH, cache)
 
     d = args[2]
     t = args[3]
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+'''
+magnet link catalogue
+
+keeps the magnets from magnet_links.txt (and extract_magnets.py / extract-magnets.sh
+output) in ~/.cache/magnet_catalog.db, one row per info hash however many times a
+torrent shows up
+
+    ./magnet_catalog.py ingest [file...]    add new lines, magnet_links.txt by default
+    ./magnet_catalog.py lookup <hash|magnet|name>
+    ./magnet_catalog.py search <query>      fuzzy, ranked like tv.py
+
+ingestion is incremental: how far into each file has been read is remembered, so
+re-importing a file that was appended to only reads the new lines. the start of the
+file and the bytes just before that point are fingerprinted, so a file that was
+replaced, truncated or regenerated in place is read again from the start, which is
+harmless since entries are deduplicated by hash. lines are only taken once they end
+in a newline
+
+understood lines are "name | magnet", a bare magnet (named from its dn), and the json
+objects of extract_magnets.py --format jsonl. bare name lines are skipped, the magnet
+line that follows them has the same name
+'''
+
+import argparse
+import base64
+import hashlib
+import heapq
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from tv import clean_string, score_match
+from urllib.parse import parse_qs, urlsplit
+
+CATALOG_PATH = os.path.expanduser('~/.cache/magnet_catalog.db')
+# how much of the start of a file, and of what comes just before where reading stopped,
+# has to be unchanged for an ingest to carry on from there
+FINGERPRINT_BYTES = 4096
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'magnet_links.txt')
+
+# how many ranked matches search shows
+max_results = 20
+
+BTIH_RE = re.compile(r'xt=urn:btih:([0-9a-f]{40}|[a-z2-7]{32})', re.IGNORECASE)
+HASH_RE = re.compile(r'[0-9a-f]{40}|[a-z2-7]{32}', re.IGNORECASE)
+
+
+def normalize_hash(btih:str) -> str:
+    '''lowercase hex, base32 hashes are converted'''
+    if len(btih) == 32:
+        return base64.b32decode(btih.upper()).hex()
+    return btih.lower()
+
+
+def parse_line(line:str) -> tuple[str, str, str]:
+    '''
+    return (btih, name, magnet) for a catalogue line, or None if it doesn't hold a magnet
+    '''
+    if line.startswith('{'):
+        try:
+            obj = json.loads(line)
+            line = f'{obj["name"]} | {obj["magnet"]}'
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    start = line.find('magnet:?')
+    if start < 0:
+        return None
+    magnet = line[start:].strip()
+    match = BTIH_RE.search(magnet)
+    if not match:
+        return None
+
+    name = line[:start].rstrip(' |\t')
+    if not name:
+        name = parse_qs(urlsplit(magnet).query).get('dn', [''])[0]
+    return normalize_hash(match.group(1)), name, magnet
+
+
+def open_catalog(path:str) -> sqlite3.Connection:
+    '''open the catalogue, creating it if needed'''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path)
+    # catalogues from before fingerprints were kept just read their files once more
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(sources)')]
+    if columns and 'fingerprint' not in columns:
+        conn.execute('DROP TABLE sources')
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS magnets (
+            id INTEGER PRIMARY KEY,
+            btih TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL,
+            name_key TEXT NOT NULL,
+            magnet TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS magnets_name ON magnets (name COLLATE NOCASE);
+
+        -- trigrams of name_key, narrows down candidates for search like tv.py's index
+        CREATE VIRTUAL TABLE IF NOT EXISTS magnets_fts USING fts5(
+            name_key, content='magnets', content_rowid='id', tokenize='trigram'
+        );
+        CREATE TRIGGER IF NOT EXISTS magnets_insert AFTER INSERT ON magnets BEGIN
+            INSERT INTO magnets_fts (rowid, name_key) VALUES (new.id, new.name_key);
+        END;
+        CREATE TRIGGER IF NOT EXISTS magnets_update AFTER UPDATE OF name_key ON magnets BEGIN
+            INSERT INTO magnets_fts (magnets_fts, rowid, name_key) VALUES ('delete', old.id, old.name_key);
+            INSERT INTO magnets_fts (rowid, name_key) VALUES (new.id, new.name_key);
+        END;
+
+        -- how far into each ingested file has been read
+        CREATE TABLE IF NOT EXISTS sources (
+            path TEXT PRIMARY KEY,
+            inode INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL
+        );
+    ''')
+    return conn
+
+
+def fingerprint(f, offset:int) -> str:
+    '''hash of the first and the last FINGERPRINT_BYTES before offset in the open file f'''
+    digest = hashlib.sha1()
+    f.seek(0)
+    digest.update(f.read(min(offset, FINGERPRINT_BYTES)))
+    tail = max(0, offset - FINGERPRINT_BYTES)
+    f.seek(tail)
+    digest.update(f.read(offset - tail))
+    return digest.hexdigest()
+
+
+def ingest(conn:sqlite3.Connection, path:str, full:bool=False) -> dict:
+    '''
+    add the lines of path that haven't been read yet, returns counts of lines read and magnets added
+    '''
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    row = conn.execute('SELECT inode, offset, fingerprint FROM sources WHERE path = ?', (path,)).fetchone()
+
+    with open(path, 'rb') as f:
+        # carry on where the last ingest stopped only if what it read is still there
+        offset = 0
+        if row and not full and row[0] == st.st_ino and row[1] <= st.st_size and fingerprint(f, row[1]) == row[2]:
+            offset = row[1]
+        f.seek(offset)
+        data = f.read()
+        # an unfinished last line waits for the next run
+        end = data.rfind(b'\n') + 1
+        read_to = fingerprint(f, offset + end)
+    lines = data[:end].decode('utf-8', 'replace').splitlines()
+
+    entries = []
+    for line in lines:
+        if parsed := parse_line(line):
+            btih, name, magnet = parsed
+            entries.append((btih, name, clean_string(name), magnet))
+
+    count = 'SELECT COUNT(*) FROM magnets'
+    before = conn.execute(count).fetchone()[0]
+    with conn:
+        # the first name seen for a hash is kept, unless it was empty
+        conn.executemany('''
+            INSERT INTO magnets (btih, name, name_key, magnet) VALUES (?, ?, ?, ?)
+            ON CONFLICT (btih) DO UPDATE SET name = excluded.name, name_key = excluded.name_key
+            WHERE magnets.name = '' AND excluded.name != ''
+        ''', entries)
+        added = conn.execute(count).fetchone()[0] - before
+        conn.execute('INSERT OR REPLACE INTO sources (path, inode, offset, fingerprint) VALUES (?, ?, ?, ?)',
+                     (path, st.st_ino, offset + end, read_to))
+    return {'lines': len(lines), 'magnets': len(entries), 'added': added, 'offset': offset}
+
+
+def lookup(conn:sqlite3.Connection, term:str) -> list[tuple[str, str]]:
+    '''(name, magnet) for a hash, a magnet link or an exact name (case insensitive)'''
+    term = term.strip()
+    if match := BTIH_RE.search(term):
+        term = match.group(1)
+    if HASH_RE.fullmatch(term):
+        rows = conn.execute('SELECT name, magnet FROM magnets WHERE btih = ?', (normalize_hash(term),))
+    else:
+        rows = conn.execute('SELECT name, magnet FROM magnets WHERE name = ? COLLATE NOCASE', (term,))
+    return rows.fetchall()
+
+
+def search(conn:sqlite3.Connection, query:str, limit:int=max_results) -> list[tuple[str, str]]:
+    '''
+    best limit (name, magnet) for a fuzzy query, best first
+    like tv.py, the first word's trigrams pick the candidates and the whole query is scored against them
+    '''
+    words = query.split()
+    if not words:
+        return []
+    first_word = clean_string(words[0])
+    full_query = clean_string(''.join(words))
+    if not full_query:
+        return []
+
+    if len(first_word) >= 3:
+        rows = conn.execute('''
+            SELECT name, magnet FROM magnets
+            WHERE id IN (SELECT rowid FROM magnets_fts WHERE magnets_fts MATCH ?)
+        ''', (f'"{first_word}"',))
+    else:
+        rows = conn.execute('SELECT name, magnet FROM magnets')
+
+    scored = (
+        (score, -len(name), name, magnet)
+        for name, magnet in rows
+        if (score := score_match(full_query, name.lower())) is not None
+    )
+    return [(name, magnet) for _, _, name, magnet in heapq.nlargest(limit, scored)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='deduplicated, searchable catalogue of magnet links')
+    parser.add_argument('--db', default=CATALOG_PATH, help='default %(default)s')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = commands.add_parser('ingest', help='add new lines from "name | magnet" files')
+    ingest_parser.add_argument('files', nargs='*', default=[DEFAULT_SOURCE])
+    ingest_parser.add_argument('--full', action='store_true', help='read the files from the start again')
+    lookup_parser = commands.add_parser('lookup', help='find by info hash, magnet link or exact name')
+    lookup_parser.add_argument('term', nargs='+')
+    search_parser = commands.add_parser('search', help='fuzzy search by name')
+    search_parser.add_argument('query', nargs='+')
+    search_parser.add_argument('--limit', type=int, default=max_results)
+    args = parser.parse_args()
+
+    conn = open_catalog(args.db)
+    start = time.perf_counter()
+
+    if args.command == 'ingest':
+        for path in args.files:
+            try:
+                counts = ingest(conn, path, args.full)
+            except OSError as e:
+                print(f'{path}: {e}', file=sys.stderr)
+                continue
+            print(f'{path}: {counts["lines"]} new lines from byte {counts["offset"]}, '
+                  f'{counts["magnets"]} magnets, {counts["added"]} added', file=sys.stderr)
+        total = conn.execute('SELECT COUNT(*) FROM magnets').fetchone()[0]
+        print(f'{total} magnets in the catalogue, ingested in {time.perf_counter() - start:.2f}s', file=sys.stderr)
+        return
+
+    if args.command == 'lookup':
+        results = lookup(conn, ' '.join(args.term))
+    else:
+        results = search(conn, ' '.join(args.query), args.limit)
+    elapsed = time.perf_counter() - start
+
+    for name, magnet in results:
+        print(f'{name} | {magnet}')
+    print(f'{len(results)} found in {elapsed * 1000:.2f} ms', file=sys.stderr)
+    if not results:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
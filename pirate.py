@@ -2,18 +2,87 @@
 
 '''
 Send an http request to a url and format the response in an easy-to-parse format
+
+./pirate.py [query] searches every source, prints the results as a table and opens the
+magnet link of the one you pick. both the classic html results page (table#searchResult)
+and the apibay style json api are understood.
+
+sources are search urls the quoted query is appended to, from --source (repeatable) or
+$PIRATE_SOURCES (space separated), url_base otherwise. they are all queried at once, each
+with its own timeout, and results are merged by the info hash in their magnet link. the
+table is shown GRACE_SECONDS after the first source answers, so one slow or dead mirror
+doesn't hold everything up.
+
+requests go through one pooled session with timeouts and retries. parsed results are
+cached in ~/.cache/pirate.json for CACHE_TTL_MINUTES keyed by the search url, so a
+repeated query doesn't touch the network. if the site is down, an expired entry is
+used rather than giving up.
+
+results pages are parsed with lxml when it's installed, which is several times faster
+than beautifulsoup, and with beautifulsoup's html.parser restricted to the results table
+otherwise. ./pirate.py --bench [page.html...] times each backend over saved pages
+(e.g. from curl, pirate_results_sample.html by default) and checks they agree, then
+checks the parser against pirate_results_sample.html and pirate_api_sample.json, which
+hold the same torrents. an upload date that can't be read is left empty
+
+to try it against saved pages instead of the real site, serve them locally, e.g.
+    python -m http.server -d saved_pages 8000
+    ./pirate.py --source 'http://localhost:8000/results.html?q=' ubuntu
 '''
 
+import argparse
+import asyncio
+import base64
+import json
+import os
 import prettytable
 import re
 import requests
 import sys
+import threading
+import time
 import webbrowser
 
-from bs4 import BeautifulSoup
-from datetime import datetime
+from bs4 import BeautifulSoup, SoupStrainer
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote, quote_plus, urlsplit
+from urllib3.util.retry import Retry
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
 
 url_base = 'https://thepiratebay.org/search.php?q='
+SOURCES = os.environ.get('PIRATE_SOURCES', url_base).split()
+
+CACHE_PATH = os.path.expanduser('~/.cache/pirate.json')
+CACHE_TTL_MINUTES = 60
+
+# (connect, read) seconds
+TIMEOUT = (5, 20)
+MAX_RETRIES = 3
+# how long a single source gets, and how long to wait for the rest once one has answered
+SOURCE_TIMEOUT = 10
+GRACE_SECONDS = 1.5
+
+# Uploaded 03-14&nbsp;2019, Size 1.2&nbsp;GiB, ULed by someone
+DESCRIPTION_RE = re.compile(
+    r'Uploaded\s+(?P<uploaded>.+?),\s*Size\s+(?P<size>[\d.]+)\s*(?P<unit>[KMGT]?i?B),\s*ULed\s+by\s+(?P<username>.*)',
+    re.IGNORECASE,
+)
+MINUTES_AGO_RE = re.compile(r'(\d+)\s+mins?\s+ago', re.IGNORECASE)
+CATEGORY_RE = re.compile(r'/browse/(\d+)')
+BTIH_RE = re.compile(r'xt=urn:btih:([0-9a-f]{40}|[a-z2-7]{32})', re.IGNORECASE)
+SIZE_UNITS = {'b': 0, 'k': 1, 'm': 2, 'g': 3, 't': 4}
+
+# a saved results page and the json api's answer for the same torrents, for --bench
+SAMPLE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_PAGE = os.path.join(SAMPLE_DIR, 'pirate_results_sample.html')
+SAMPLE_API = os.path.join(SAMPLE_DIR, 'pirate_api_sample.json')
+# what the html and the api have to agree on, the page only shows rounded sizes and dates
+SAMPLE_FIELDS = ('category', 'name', 'username', 'seeders', 'leechers')
 
 
 def format_bytes(size:int) -> str:
@@ -27,13 +96,358 @@ def format_bytes(size:int) -> str:
         4: 'TB',
     }
     n = 0
-    while size > power:
+    while size > power and n < 4:
         size /= power
         n += 1
     return str(round(size, 2)) + ' ' + labels[n]
 
 
-def build_table_row(index:int, obj):
+def parse_size(number:str, unit:str) -> int:
+    '''1.2 GiB -> bytes, the site's KB/MB/GB are binary too'''
+    return int(float(number) * 1024 ** SIZE_UNITS[unit[0].lower()])
+
+
+def parse_uploaded(text:str, now:datetime) -> int:
+    '''
+    turn the results page upload date into a timestamp, None if it isn't one we know
+    it's one of 03-14 2019, 03-14 12:30 (this year), Today 12:30, Y-day 12:30 or 5 mins ago
+    '''
+    text = ' '.join(text.split())
+    if match := MINUTES_AGO_RE.search(text):
+        return int((now - timedelta(minutes=int(match.group(1)))).timestamp())
+    day, _, clock = text.partition(' ')
+    try:
+        if day.lower() in ('today', 'y-day'):
+            added = datetime.combine(now.date(), datetime.strptime(clock, '%H:%M').time())
+            if day.lower() == 'y-day':
+                added -= timedelta(days=1)
+        elif ':' in clock:
+            added = datetime.strptime(f'{now.year} {text}', '%Y %m-%d %H:%M')
+            if added > now:
+                added = added.replace(year=now.year - 1)
+        else:
+            added = datetime.strptime(text, '%m-%d %Y')
+    except ValueError:
+        return None
+    return int(added.timestamp())
+
+
+def result_from_row(name:str, magnet:str, description:str, category_hrefs:list, seeders:str, leechers:str, now:datetime) -> dict:
+    '''build a result from the text pulled out of one table row, None if it isn't a result'''
+    match = DESCRIPTION_RE.search(description.replace('\xa0', ' '))
+    if not match:
+        return None
+    categories = CATEGORY_RE.findall(' '.join(category_hrefs))
+    return {
+        'category': categories[-1] if categories else '0',
+        'name': name.strip(),
+        'size': parse_size(match['size'], match['unit']),
+        'added': parse_uploaded(match['uploaded'], now),
+        'username': match['username'].strip(),
+        'seeders': int(seeders.strip() or 0),
+        'leechers': int(leechers.strip() or 0),
+        'magnet': magnet,
+    }
+
+
+def rows_lxml(content:bytes):
+    '''yield the fields of each results row, using lxml and xpath'''
+    if not content.strip():
+        return
+    document = lxml.html.fromstring(content)
+    for row in document.xpath('//table[@id="searchResult"]//tr'):
+        name = row.xpath('.//a[contains(concat(" ", @class, " "), " detLink ")]')
+        magnet = row.xpath('.//a[starts-with(@href, "magnet:")]/@href')
+        description = row.xpath('.//font[contains(concat(" ", @class, " "), " detDesc ")]')
+        cells = row.xpath('./td')
+        if not (name and magnet and description) or len(cells) < 3:
+            continue
+        yield (
+            name[0].text_content(), magnet[0], description[0].text_content(),
+            cells[0].xpath('.//a/@href'), cells[-2].text_content(), cells[-1].text_content(),
+        )
+
+
+def rows_soup(content:bytes):
+    '''yield the fields of each results row, using beautifulsoup's pure python parser on just the results table'''
+    soup = BeautifulSoup(content, 'html.parser', parse_only=SoupStrainer('table', id='searchResult'))
+    for row in soup.select('table#searchResult tr'):
+        name = row.select_one('a.detLink')
+        magnet = row.select_one('a[href^="magnet:"]')
+        description = row.select_one('font.detDesc')
+        cells = row.find_all('td', recursive=False)
+        if not (name and magnet and description) or len(cells) < 3:
+            continue
+        yield (
+            name.get_text(), magnet['href'], description.get_text(' '),
+            [a['href'] for a in cells[0].select('a[href]')], cells[-2].get_text(), cells[-1].get_text(),
+        )
+
+
+# fastest first, lxml is optional
+HTML_BACKENDS = {'lxml': rows_lxml, 'html.parser': rows_soup} if lxml else {'html.parser': rows_soup}
+
+
+def parse_html_results(content:bytes, backend:str=None, now:datetime=None) -> list[dict]:
+    '''
+    pull the rows out of a classic results page, in the same shape as the json api
+    rows that don't look like results (the header, the pager) are skipped
+    backend is a key of HTML_BACKENDS, the fastest available one by default
+    '''
+    rows = HTML_BACKENDS[backend or next(iter(HTML_BACKENDS))]
+    now = now or datetime.now()
+    results = []
+    for fields in rows(content):
+        if result := result_from_row(*fields, now):
+            results.append(result)
+    return results
+
+
+def benchmark(pages:list, rounds:int) -> bool:
+    '''print rows/second for each html backend over saved results pages, returns whether they all agree'''
+    contents = []
+    for path in pages:
+        with open(path, 'rb') as f:
+            contents.append(f.read())
+
+    # relative dates like "5 mins ago" have to come out the same for every backend
+    now = datetime.now()
+    expected = None
+    agree = True
+    print(f'{len(pages)} pages x {rounds} rounds')
+    for backend in HTML_BACKENDS:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            results = [parse_html_results(content, backend, now) for content in contents]
+        elapsed = time.perf_counter() - start
+        count = sum(len(r) for r in results)
+        print(f'{backend:12} {count * rounds / elapsed:12,.0f} rows/s  {elapsed / rounds / len(pages) * 1000:8.2f} ms/page  {count} rows')
+        if expected is None:
+            expected = results
+        elif results != expected:
+            print(f'{backend} disagrees with {next(iter(HTML_BACKENDS))}')
+            agree = False
+    return agree
+
+
+def check_samples(page_path:str=SAMPLE_PAGE, api_path:str=SAMPLE_API) -> bool:
+    '''parse the sample page with each html backend and check it against the api sample, returns whether they match'''
+    with open(api_path, 'rb') as f:
+        expected = [(info_hash(r['magnet']),) + tuple(r[field] for field in SAMPLE_FIELDS) for r in parse_api_results(f.read())]
+    with open(page_path, 'rb') as f:
+        content = f.read()
+
+    matched = True
+    for backend in HTML_BACKENDS:
+        got = [(info_hash(r['magnet']),) + tuple(r[field] for field in SAMPLE_FIELDS) for r in parse_html_results(content, backend)]
+        if got != expected:
+            matched = False
+            print(f'{backend} does not match {os.path.basename(api_path)}')
+            for g, e in zip(got, expected):
+                if g != e:
+                    print(f'  got  {g}\n  want {e}')
+            if len(got) != len(expected):
+                print(f'  {len(got)} rows, want {len(expected)}')
+    print(f'{os.path.basename(page_path)} {"matches" if matched else "does not match"} {os.path.basename(api_path)}')
+    return matched
+
+
+def parse_api_results(content:bytes) -> list[dict]:
+    '''
+    rows from the json api, which answers "no results" with a single all zero entry
+    raises ValueError for anything that isn't a list of entries, like {"error": ...}
+    '''
+    data = json.loads(content)
+    if not isinstance(data, list) or not all(isinstance(obj, dict) for obj in data):
+        raise ValueError(f'unexpected api response: {content[:100]!r}')
+    results = []
+    for obj in data:
+        if obj.get('id') == '0':
+            continue
+        results.append({
+            'category': str(obj['category']),
+            'name': obj['name'],
+            'size': int(obj['size']),
+            'added': int(obj['added']),
+            'username': obj['username'],
+            'seeders': int(obj['seeders']),
+            'leechers': int(obj['leechers']),
+            'magnet': f'magnet:?xt=urn:btih:{obj["info_hash"]}&dn={quote(obj["name"])}',
+        })
+    return results
+
+
+def parse_response(content:bytes, content_type:str='') -> list[dict]:
+    if 'json' in content_type or content.lstrip()[:1] in (b'[', b'{'):
+        return parse_api_results(content)
+    return parse_html_results(content)
+
+
+def make_session() -> requests.Session:
+    '''one keep-alive session, retrying connection errors and 429/5xx with backoff'''
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=('GET',),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=8)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0'
+    return session
+
+
+def load_cache(path:str) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path:str, cache:dict) -> None:
+    # anything past its ttl is only kept around as an offline fallback for a day
+    cutoff = time.time() - max(CACHE_TTL_MINUTES * 60, 24 * 60 * 60)
+    # copied first, sources that were given up on may still be adding to it
+    cache = {url: entry for url, entry in dict(cache).items() if entry['fetched'] > cutoff}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def search(session:requests.Session, url:str, cache:dict=None, refresh:bool=False, timeout=TIMEOUT) -> list[dict]:
+    '''
+    fetch and parse one search url, going through the cache when one is given
+    raises requests.RequestException if the site can't be reached and nothing is cached
+    '''
+    entry = cache.get(url) if cache is not None else None
+    if entry and not refresh and time.time() - entry['fetched'] < CACHE_TTL_MINUTES * 60:
+        return entry['results']
+
+    try:
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        if not entry:
+            raise
+        age = (time.time() - entry['fetched']) / 60
+        print(f'Warning: search failed ({e}), using results cached {age:.0f} minutes ago', file=sys.stderr)
+        return entry['results']
+
+    results = parse_response(response.content, response.headers.get('Content-Type', ''))
+    if cache is not None:
+        cache[url] = {'fetched': time.time(), 'results': results}
+    return results
+
+
+def info_hash(magnet:str) -> str:
+    '''the lowercase hex btih of a magnet link, base32 ones are converted, None if there isn't one'''
+    match = BTIH_RE.search(magnet)
+    if not match:
+        return None
+    btih = match.group(1)
+    if len(btih) == 32:
+        btih = base64.b32decode(btih.upper()).hex()
+    return btih.lower()
+
+
+def merge_results(result_lists:list) -> list[dict]:
+    '''
+    merge results from several sources, one per info hash, keeping the highest peer counts
+    sources disagree on those since they scrape trackers at different times. best seeded first
+    '''
+    merged = {}
+    for results in result_lists:
+        for result in results:
+            key = info_hash(result['magnet']) or result['magnet']
+            if key not in merged:
+                merged[key] = dict(result)
+            else:
+                merged[key]['seeders'] = max(merged[key]['seeders'], result['seeders'])
+                merged[key]['leechers'] = max(merged[key]['leechers'], result['leechers'])
+    return sorted(merged.values(), key=lambda result: result['seeders'], reverse=True)
+
+
+def run_in_daemon_thread(loop:asyncio.AbstractEventLoop, func, *args) -> asyncio.Future:
+    '''
+    run func on a daemon thread and return a future for it. unlike an executor's threads,
+    a source that was given up on can't hold up the interpreter exiting
+    '''
+    future = loop.create_future()
+
+    def resolve(result, error):
+        if future.done(): # cancelled, nobody is waiting any more
+            return
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run():
+        result = error = None
+        try:
+            result = func(*args)
+        except Exception as e:
+            error = e
+        try:
+            loop.call_soon_threadsafe(resolve, result, error)
+        except RuntimeError: # the loop has been closed
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+async def search_sources(session:requests.Session, urls:list, cache:dict=None, refresh:bool=False,
+                         source_timeout:float=SOURCE_TIMEOUT, grace:float=GRACE_SECONDS) -> list[dict]:
+    '''
+    search all the urls at once and return the merged results
+    once a source has returned results the others get grace more seconds, anything still
+    running after that is left behind. prints how each source did to stderr
+    '''
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    tasks = {}
+    for url in urls:
+        fetch = run_in_daemon_thread(loop, search, session, url, cache, refresh, (TIMEOUT[0], source_timeout))
+        tasks[asyncio.ensure_future(asyncio.wait_for(fetch, source_timeout))] = url
+
+    result_lists = []
+    pending = set(tasks)
+    deadline = None
+    while pending:
+        timeout = None if deadline is None else max(0, deadline - loop.time())
+        done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            source = urlsplit(tasks[task]).netloc
+            try:
+                results = task.result()
+            except asyncio.TimeoutError:
+                print(f'{source}: timed out after {source_timeout}s', file=sys.stderr)
+                continue
+            except Exception as e:
+                # whatever goes wrong with one source, the others still count
+                print(f'{source}: failed, {e or type(e).__name__}', file=sys.stderr)
+                continue
+            print(f'{source}: {len(results)} results in {loop.time() - start:.1f}s', file=sys.stderr)
+            result_lists.append(results)
+            if results and deadline is None:
+                deadline = loop.time() + grace
+        if not done:
+            break
+
+    for task in pending:
+        task.cancel()
+        print(f'{urlsplit(tasks[task]).netloc}: still waiting after {loop.time() - start:.1f}s, skipped', file=sys.stderr)
+    return merge_results(result_lists)
+
+
+def build_table_row(index:int, obj:dict) -> list:
     '''Build the table to print to stdout for the user'''
     categories = {
         '0': '',
@@ -46,11 +460,11 @@ def build_table_row(index:int, obj):
     }
 
     row = []
-    row.append(i+1)
-    row.append(categories[obj['category'][0]])
+    row.append(index)
+    row.append(categories.get(obj['category'][0], ''))
     row.append(obj['name'])
+    row.append(datetime.fromtimestamp(int(obj['added'])).strftime('%Y-%m-%d') if obj['added'] is not None else '')
     row.append(format_bytes(int(obj['size'])))
-    row.append(datetime.fromtimestamp(int(obj['added'])).strftime('%Y-%m-%d'))
     row.append(obj['username'])
     row.append(obj['seeders'])
     row.append(obj['leechers'])
@@ -59,12 +473,30 @@ def build_table_row(index:int, obj):
 
 
 def main():
-    content_query = input('What would you like to download? ')
-    response = requests.get(f'{url_base}{content_query}')
-    
-    soup = BeautifulSoup(response.content, 'html.parser')
+    parser = argparse.ArgumentParser(description='search for torrents and open the chosen magnet link')
+    parser.add_argument('query', nargs='*', help='what to search for, asked for if not given')
+    parser.add_argument('--source', action='append', dest='sources', metavar='URL',
+                        help='search url the quoted query is appended to, repeatable (default $PIRATE_SOURCES or url_base)')
+    parser.add_argument('--source-timeout', type=float, default=SOURCE_TIMEOUT, help='seconds each source gets (default %(default)s)')
+    parser.add_argument('--grace', type=float, default=GRACE_SECONDS,
+                        help='seconds to wait for the other sources once one has answered (default %(default)s)')
+    parser.add_argument('--refresh', action='store_true', help='ignore cached results for this query')
+    parser.add_argument('--bench', nargs='*', metavar='PAGE',
+                        help='time each html backend over saved results pages (default the sample page) and check the parser against the samples')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.bench is not None:
+        agree = benchmark(args.bench or [SAMPLE_PAGE], args.rounds)
+        sys.exit(0 if check_samples() and agree else 1)
+
+    content_query = ' '.join(args.query) or input('What would you like to download? ')
+    urls = [f'{source}{quote_plus(content_query)}' for source in args.sources or SOURCES]
 
-    search_results = soup.select('div#main-content')
+    cache = load_cache(CACHE_PATH)
+    with make_session() as session:
+        search_results = asyncio.run(search_sources(session, urls, cache, args.refresh, args.source_timeout, args.grace))
+    save_cache(CACHE_PATH, cache)
 
     if search_results:
         magnet_links = dict()
@@ -83,17 +515,17 @@ def main():
         table.align = 'l'
         table.padding_width = 2
 
-        for i, result in enumerate(search_results):
-            row = build_table_row(result)
-            table.add_row(i+1, row)
-            magnet = result.select_one('a[href^=magnet]')
-            if magnet:
-                magnet_links[i+1] = magnet
+        for i, result in enumerate(search_results, 1):
+            table.add_row(build_table_row(i, result))
+            magnet_links[i] = result['magnet']
 
         # now that we've parsed the search results, print the table and ask for which element to download
         print(table)
-        download_selection = input('Select which number to download')
-        webbrowser.open(magnet_links[download_selection])
+        download_selection = input('Select which number to download: ').strip()
+        if not download_selection.isdigit() or int(download_selection) not in magnet_links:
+            print(f'{download_selection} is not one of the results')
+            sys.exit(1)
+        webbrowser.open(magnet_links[int(download_selection)])
 
     else:
         print('Could not find any elements that matched your query')
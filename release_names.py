@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+'''
+release name parser
+
+pulls title, year, season, episode(s), absolute episode and air date out of
+torrent/scene style release names like
+    The.Sinner.S01E01E02.720p.WEBRip.x264-GalaxyTV
+    Show Name 1x02 HDTV
+    [SubsPlease] Some Anime - 1071 (1080p).mkv
+    The.Daily.Show.2024.03.14.1080p.WEB.h264
+
+run ./release_names.py --bench to time the parser over release_names_corpus.tsv
+and check its accuracy against the expected values in there
+'''
+
+import argparse
+import csv
+import functools
+import os
+import re
+import sys
+import time
+
+from typing import NamedTuple
+
+
+class ReleaseInfo(NamedTuple):
+    title: str
+    year: int
+    season: int
+    episodes: tuple[int, ...]
+    absolute_episode: int
+    air_date: str # YYYY-MM-DD
+
+    @property
+    def episode(self) -> int:
+        '''first episode, for callers that only handle one'''
+        return self.episodes[0] if self.episodes else None
+
+
+VIDEO_EXTENSION_RE = re.compile(r'\.(?:mp4|mkv|avi|mov|wmv|flv|webm|srt)$', re.IGNORECASE)
+
+# S01E01, S01E01E02, S01E01-E03, S01E01-03, s1.e2
+SXXEYY_RE = re.compile(
+    r'(?<![a-z0-9])s(\d{1,2})[ ._-]*e(\d{1,3})((?:[ ._]?-?[ ._]?e\d{1,3}|-\d{1,3}(?![\dp]))*)',
+    re.IGNORECASE,
+)
+MULTI_EPISODE_RE = re.compile(r'(-)?\s*e?(\d{1,3})', re.IGNORECASE)
+# 1x02, 1x02x03, 1x02-03. the lookarounds keep 1920x1080 out
+NXNN_RE = re.compile(r'(?<![\dx])(\d{1,2})x(\d{2,3})((?:[x-]\d{2,3})*)(?![\dp])', re.IGNORECASE)
+# Season 1 Episode 2
+SEASON_EPISODE_WORDS_RE = re.compile(r'\bseason[ ._-]*(\d{1,2})[ ._-]*episode[ ._-]*(\d{1,3})\b', re.IGNORECASE)
+# 2024.03.14 for daily shows
+AIR_DATE_RE = re.compile(r'(?<!\d)((?:19|20)\d{2})[ ._-](\d{2})[ ._-](\d{2})(?!\d)')
+# Title - 1071 for anime absolute numbering, 1080p and friends are excluded by the lookahead
+ABSOLUTE_RE = re.compile(r'\s-\s(\d{2,4})(?:v\d)?(?=[ ._\[(]|$)')
+# season packs: Season 2, S02, S01-S04
+SEASON_RE = re.compile(r'\bseason[ ._-]*(\d{1,2})\b|(?<![a-z0-9])s(\d{1,2})(?![\de])', re.IGNORECASE)
+YEAR_RE = re.compile(r'(?<![\d])(19\d{2}|20\d{2})(?!\d|p)')
+# where the title stops if nothing else cuts it short
+TAG_RE = re.compile(
+    r'[(\[]|\b(?:480p|576p|720p|1080p|2160p|4k|uhd|bluray|brrip|bdrip|web-?dl|webrip|web|hdtv|hdrip|dvdrip'
+    r'|x264|x265|h264|h265|hevc|remux|complete|extended|remastered|criterion|repack|proper)\b',
+    re.IGNORECASE,
+)
+# leading junk like "[SubsPlease] " or "www.UIndex.org    -    "
+PREFIX_RE = re.compile(r'^(?:\[[^\]]*\]\s*|www\.\S+\s*-\s*)+', re.IGNORECASE)
+SEPARATORS_RE = re.compile(r'[._]+')
+SPACES_RE = re.compile(r'\s+')
+
+# a range like E01-E05 is expanded, but nothing silly
+MAX_EPISODE_RANGE = 30
+
+
+def expand_episodes(first:int, tail:str, pattern:re.Pattern) -> tuple[int, ...]:
+    '''turn the first episode plus the rest of a multi-episode token into a tuple of episodes'''
+    episodes = [first]
+    for dash, number in pattern.findall(tail):
+        number = int(number)
+        if dash and 0 < number - episodes[-1] <= MAX_EPISODE_RANGE:
+            episodes.extend(range(episodes[-1] + 1, number + 1))
+        elif number not in episodes:
+            episodes.append(number)
+    return tuple(episodes)
+
+
+def clean_title(raw:str) -> str:
+    title = SEPARATORS_RE.sub(' ', raw)
+    title = SPACES_RE.sub(' ', title)
+    return title.strip(' -')
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_release_name(name:str) -> ReleaseInfo:
+    '''
+    parse a file or directory name. any field that isn't present is None (episodes is empty)
+    results are cached, since the same directory names come up for every file in them
+    '''
+    name = VIDEO_EXTENSION_RE.sub('', name)
+    name = PREFIX_RE.sub('', name)
+
+    season = absolute = air_date = None
+    episodes = ()
+    cut = len(name) # where the title ends
+
+    if match := SXXEYY_RE.search(name):
+        season = int(match.group(1))
+        episodes = expand_episodes(int(match.group(2)), match.group(3), MULTI_EPISODE_RE)
+        cut = match.start()
+    elif match := NXNN_RE.search(name):
+        season = int(match.group(1))
+        episodes = expand_episodes(int(match.group(2)), match.group(3).replace('x', ''), MULTI_EPISODE_RE)
+        cut = match.start()
+    elif match := SEASON_EPISODE_WORDS_RE.search(name):
+        season = int(match.group(1))
+        episodes = (int(match.group(2)),)
+        cut = match.start()
+    elif (match := AIR_DATE_RE.search(name)) and 1 <= int(match.group(2)) <= 12 and 1 <= int(match.group(3)) <= 31:
+        air_date = f'{match.group(1)}-{match.group(2)}-{match.group(3)}'
+        cut = match.start()
+    else:
+        if match := SEASON_RE.search(name):
+            season = int(match.group(1) or match.group(2))
+            cut = match.start()
+        if (match := ABSOLUTE_RE.search(name)) and not YEAR_RE.fullmatch(match.group(1)):
+            absolute = int(match.group(1))
+            cut = min(cut, match.start())
+
+    year = None
+    if match := YEAR_RE.search(name, 1): # a title can't be only a year, so skip position 0
+        if air_date is None or match.start() < cut:
+            year = int(match.group(1))
+        if match.start() < cut:
+            cut = match.start()
+
+    if match := TAG_RE.search(name, 0, cut):
+        if match.start() > 0:
+            cut = match.start()
+
+    return ReleaseInfo(clean_title(name[:cut]), year, season, episodes, absolute, air_date)
+
+
+def load_corpus(path:str) -> list[tuple[str, ReleaseInfo]]:
+    '''
+    read the benchmark corpus, a tsv of name, season, episodes, absolute_episode, air_date
+    episodes are comma separated, empty fields are None
+    '''
+    corpus = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            expected = ReleaseInfo(
+                title=None,
+                year=None,
+                season=int(row['season']) if row['season'] else None,
+                episodes=tuple(int(e) for e in row['episodes'].split(',') if e),
+                absolute_episode=int(row['absolute_episode']) if row['absolute_episode'] else None,
+                air_date=row['air_date'] or None,
+            )
+            corpus.append((row['name'], expected))
+    return corpus
+
+
+def benchmark(corpus_path:str, rounds:int) -> float:
+    '''print files/second cold and cached plus accuracy, returns the accuracy'''
+    corpus = load_corpus(corpus_path)
+    names = [name for name, _ in corpus]
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parse_release_name.cache_clear()
+        for name in names:
+            parse_release_name(name)
+    cold = len(names) * rounds / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for name in names:
+            parse_release_name(name)
+    cached = len(names) * rounds / (time.perf_counter() - start)
+
+    wrong = []
+    for name, expected in corpus:
+        info = parse_release_name(name)
+        got = (info.season, info.episodes, info.absolute_episode, info.air_date)
+        want = (expected.season, expected.episodes, expected.absolute_episode, expected.air_date)
+        if got != want:
+            wrong.append((name, got, want))
+
+    accuracy = 1 - len(wrong) / len(corpus)
+    print(f'{len(corpus)} names x {rounds} rounds')
+    print(f'{"cold":10} {cold:12,.0f} files/s')
+    print(f'{"cached":10} {cached:12,.0f} files/s')
+    print(f'{"accuracy":10} {accuracy:12.1%}')
+    for name, got, want in wrong:
+        print(f'  {name}\n      got  {got}\n      want {want}')
+    return accuracy
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='parse release names, or benchmark the parser')
+    parser.add_argument('names', nargs='*', help='names to parse')
+    parser.add_argument('--bench', action='store_true', help='benchmark speed and accuracy over the corpus')
+    parser.add_argument('--corpus', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'release_names_corpus.tsv'))
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--min-accuracy', type=float, default=1.0, help='exit non-zero below this accuracy (default 1.0)')
+    args = parser.parse_args()
+
+    if args.bench:
+        accuracy = benchmark(args.corpus, args.rounds)
+        sys.exit(0 if accuracy >= args.min_accuracy else 1)
+
+    for name in args.names:
+        print(f'{name}\n    {parse_release_name(name)}')
+
+
+if __name__ == '__main__':
+    main()
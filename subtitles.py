@@ -12,16 +12,74 @@
 
 # you can skip any directory by putting a file named .ignoresubtitlecheck in it
 
+# directory listings are cached in ~/.cache/subtitles.db keyed by mtime and inode,
+# so only directories that changed since the last run are listed again.
+# pass --full-rescan to ignore the cache
 
+# searches and downloads run on --workers threads, limited to --rate api requests per second.
+# a 429 from the api pauses every worker for the Retry-After the server asked for
 
+# search results are cached in the same database. a show or movie with no subtitles
+# is searched again after 1, 3, 7, 14, then every 30 days instead of every run
+
+# with --season-batch, missing episodes of the same show season in a directory are
+# looked up with one season-wide search and matched back to episodes locally
+
+# otherwise each video is first looked up by its opensubtitles moviehash, then by name.
+# hashes are cached against the file's size and mtime. pass --no-hash to skip this
+
+# --dry-run only reports what is missing, without logging in. each top level directory
+# is walked on its own thread, which pays off when shows are spread over several disks.
+# the report of missing subtitles per show and season goes to stdout as json, or to
+# --report <file>, csv if it ends in .csv
+
+# the videos a run still has to get to are journaled in the state database as the walk
+# finds them. if a run is interrupted (sleep, crash) or the daily download quota runs out,
+# the next run works through what was left, then walks the library for anything new.
+# --no-resume forgets what was left.
+# once the quota is gone no more api calls are made, the rest of the walk is only journaled
+# and the run ends cleanly. subtitles are written to a temp file and renamed into place,
+# so a half written .srt never shows up
+
+# --watch keeps running and uses inotify to notice videos as they land anywhere under the
+# library (written, or moved in like qbittorrent does when a torrent completes). once a
+# file's size has held still for WATCH_SETTLE_SECONDS it is looked up and downloaded like
+# any other. nothing runs between events. if the quota runs out, the videos that were
+# skipped are retried once the api says there are downloads left again. its metrics are
+# written every WATCH_METRICS_SECONDS and when it stops (ctrl-c or SIGTERM)
+
+# every run writes its metrics to ~/.cache/subtitles_metrics/<start time>.json (or --metrics):
+# latency histograms for directory scans, hashing, rate limiter waits and each kind of api
+# call, counts of what was scanned, found, downloaded and why anything failed, and how much
+# download quota is left. --prometheus <file> also writes them for node_exporter's textfile collector
+
+
+
+import argparse
+import bisect
+import collections
+import contextlib
+import csv
+import ctypes
+import ctypes.util
+import email.utils
+import json
 import logging
+import mmap
 import os
 import re
+import select
+import signal
+import sqlite3
 import stat
+import struct
 import sys
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from opensubtitlescom import OpenSubtitles
+from release_names import parse_release_name
 
 
 # configure logging
@@ -41,6 +99,188 @@ VIDEO_EXTENSIONS = [
     '.webm',
 ]
 SRT_EXTENSION = '.srt'
+IGNORE_FILENAME = '.ignoresubtitlecheck'
+
+# state kept between runs (scan index, etc.) lives outside the library
+# so writing it never bumps the mtime of a library directory
+STATE_DB_PATH = os.path.expanduser('~/.cache/subtitles.db')
+
+# opensubtitles.com allows 5 requests per second per ip, stay well under that by default
+DEFAULT_WORKERS = 4
+DEFAULT_RATE = 2.0
+# how long to back off on a 429 that didn't come with a Retry-After header
+DEFAULT_BACKOFF = 10.0
+MAX_RETRIES = 3
+
+# search results are cached so we don't spend quota on the same query every night.
+# misses are retried on a growing schedule, hits are kept for a month
+SEARCH_LANGUAGE = 'en'
+MISS_BACKOFF_DAYS = [1, 3, 7, 14, 30]
+HIT_TTL_DAYS = 30
+# expired entries are kept this long so a miss keeps its place in the back-off schedule
+CACHE_EVICT_AFTER_DAYS = 60
+CACHE_MAX_ENTRIES = 100000
+DAY = 24 * 60 * 60
+
+# --season-batch reads at most this many pages of a season-wide search before
+# falling back to per-episode searches for whatever is still unmatched
+MAX_SEASON_PAGES = 10
+
+# how many videos may be queued for the workers before the walk waits for them to drain.
+# this keeps memory flat however big the library is
+MAX_QUEUED_VIDEOS = 200
+
+# the opensubtitles moviehash covers the file size plus the first and last 64 KiB
+HASH_CHUNK_SIZE = 64 * 1024
+
+# the state database connection is shared by the worker threads, hold this while using it
+STATE_DB_LOCK = threading.Lock()
+
+# set once the download quota is used up, after that workers skip their videos
+# and leave them in the journal for the next run
+QUOTA_EXHAUSTED = threading.Event()
+QUOTA_STATUS = 'Download quota reached, left for the next run'
+# what the client and the api say when the quota is gone
+QUOTA_ERROR_RE = re.compile(r'download limit reached|allowed \d+ subtitles', re.IGNORECASE)
+
+# --watch: how long a new video's size has to stay the same before it's treated as complete,
+# and how often to ask the api whether the download quota has been reset
+WATCH_SETTLE_SECONDS = 3
+QUOTA_RECHECK_SECONDS = 60 * 60
+# and how often it writes its metrics, the watch never ends the way a run does
+WATCH_METRICS_SECONDS = 5 * 60
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+METRICS_DIR = os.path.expanduser('~/.cache/subtitles_metrics')
+# upper bounds of the latency histogram buckets, in seconds
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    '''
+    counters, gauges and per-stage latency histograms for one run, safe to share between threads
+    failures are counted per reason
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.failures = collections.Counter()
+        self.gauges = {}
+        self.stages = {} # stage -> {'buckets': [count per bucket, last is +Inf], 'count', 'sum', 'max'}
+
+    def count(self, name:str, n:int=1) -> None:
+        with self.lock:
+            self.counters[name] += n
+
+    def fail(self, reason:str) -> None:
+        with self.lock:
+            self.failures[reason] += 1
+
+    def set(self, name:str, value) -> None:
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, stage:str, seconds:float) -> None:
+        with self.lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = self.stages[stage] = {'buckets': [0] * (len(METRIC_BUCKETS) + 1), 'count': 0, 'sum': 0.0, 'max': 0.0}
+            hist['buckets'][bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+            hist['count'] += 1
+            hist['sum'] += seconds
+            hist['max'] = max(hist['max'], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        '''everything as plain data, histogram buckets are cumulative like prometheus's'''
+        with self.lock:
+            stages = {}
+            for stage, hist in sorted(self.stages.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, n in zip(METRIC_BUCKETS + ('+Inf',), hist['buckets']):
+                    cumulative += n
+                    buckets[str(bound)] = cumulative
+                stages[stage] = {
+                    'count': hist['count'],
+                    'sum': round(hist['sum'], 6),
+                    'mean': round(hist['sum'] / hist['count'], 6),
+                    'max': round(hist['max'], 6),
+                    'buckets': buckets,
+                }
+            return {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+                'duration': round(time.time() - self.started, 3),
+                'counters': dict(sorted(self.counters.items())),
+                'failures': dict(sorted(self.failures.items())),
+                'gauges': dict(sorted(self.gauges.items())),
+                'stages': stages,
+            }
+
+    def write_json(self, path:str) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp_path, path)
+
+    def write_prometheus(self, path:str) -> None:
+        '''
+        write the textfile collector format. the counts are for the last run, so they're gauges
+        written to a temp file and renamed, node_exporter must never see half a file
+        '''
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        snapshot = self.snapshot()
+        lines = [
+            '# TYPE subtitles_last_run_timestamp_seconds gauge',
+            f'subtitles_last_run_timestamp_seconds {self.started:.0f}',
+            '# TYPE subtitles_last_run_duration_seconds gauge',
+            f'subtitles_last_run_duration_seconds {snapshot["duration"]}',
+        ]
+        for name, value in {**snapshot['counters'], **snapshot['gauges']}.items():
+            if isinstance(value, (int, float)):
+                lines.append(f'# TYPE subtitles_last_run_{name} gauge')
+                lines.append(f'subtitles_last_run_{name} {value}')
+        lines.append('# TYPE subtitles_last_run_failed gauge')
+        for reason, n in snapshot['failures'].items():
+            lines.append(f'subtitles_last_run_failed{{reason="{escape(reason)}"}} {n}')
+        lines.append('# TYPE subtitles_stage_seconds histogram')
+        for stage, hist in snapshot['stages'].items():
+            for bound, n in hist['buckets'].items():
+                lines.append(f'subtitles_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {n}')
+            lines.append(f'subtitles_stage_seconds_sum{{stage="{stage}"}} {hist["sum"]}')
+            lines.append(f'subtitles_stage_seconds_count{{stage="{stage}"}} {hist["count"]}')
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+# one per run, shared by the walk and the workers
+METRICS = Metrics()
 
 
 def get_api_key() -> tuple[str, str, str]:
@@ -95,16 +335,20 @@ def extract_show_info(search_root:str, filepath:str) -> tuple[str, int, int]:
     '''
     try to get show name, season, and episode from a filepath
     show name is expected to be one level below search_root
-    season and episode are expected to be in the filename
+    season and episode are expected to be in the filename, or failing that its directory
+    for multi-episode files this is the first episode
     '''
     relpath = os.path.relpath(filepath, search_root)
     show_name = os.path.normpath(relpath).split(os.sep)[0]
 
-    match = re.search(r'(S?(\d{1,2}))[ ._-]*E(\d{1,2})', os.path.basename(filepath), re.IGNORECASE)
-    if not match:
-        match = re.search(r'(S?(\d{1,2}))[ ._-]*E(\d{1,2})', os.path.dirname(filepath), re.IGNORECASE)
-    season = int(match.group(2)) if match else None
-    episode = int(match.group(3)) if match else None
+    info = parse_release_name(os.path.basename(filepath))
+    season, episode = info.season, info.episode
+    if season is None or episode is None:
+        dir_info = parse_release_name(os.path.basename(os.path.dirname(filepath)))
+        season = season if season is not None else dir_info.season
+        episode = episode if episode is not None else dir_info.episode
+        if season is None or episode is None:
+            season = episode = None
 
     return show_name, season, episode
 
@@ -124,115 +368,1137 @@ def extract_movie_info(search_root:str, filepath:str) -> str:
     return movie_name
 
 
-def main() -> None:
-    if len(sys.argv) < 2:
-        print(f'Usage: {os.path.relpath(__file__)} <directory>')
-        sys.exit(1)
+def open_state_db(path:str) -> sqlite3.Connection:
+    '''
+    open the sqlite database that holds state between runs, creating it if needed
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # shared with the worker threads, see STATE_DB_LOCK
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS scan_index (
+            dirpath TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            ignored INTEGER NOT NULL,
+            subdirs TEXT NOT NULL,
+            videos TEXT NOT NULL,
+            run_id INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS video_hash (
+            filepath TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            moviehash TEXT
+        );
+        CREATE TABLE IF NOT EXISTS search_cache (
+            query_key TEXT PRIMARY KEY,
+            file_id INTEGER,
+            misses INTEGER NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS run_journal (
+            search_root TEXT PRIMARY KEY,
+            walk_complete INTEGER NOT NULL,
+            started REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS pending_video (
+            filepath TEXT PRIMARY KEY,
+            search_root TEXT NOT NULL,
+            dirpath TEXT NOT NULL,
+            position INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS pending_video_root ON pending_video (search_root, position);
+    ''')
+    return conn
 
-    search_root = os.path.abspath(sys.argv[1])
-    if not os.path.isdir(search_root):
-        print(f'Error: {search_root} is not a directory')
-        sys.exit(1)
 
-    start_time = time.strftime('%Y-%m-%d %H:%M:%S')
-    logging.info(f'==== Subtitle check started at {start_time} ====')
-    logging.info(f'Searching for subtitles in {search_root}')
+def scan_directory(dirpath:str) -> tuple[bool, list[str], list[tuple[str, bool]]]:
+    '''
+    list a directory once and return (ignored, subdirs, videos)
+    videos is a list of (filename, has_sub), with has_sub answered from the same listing
+    '''
+    subdirs = []
+    filenames = set()
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            else:
+                filenames.add(entry.name)
 
-    USER, PASS, API_KEY = get_api_key()
-    client = OpenSubtitles(user_agent='SubtitleGrabber', api_key=API_KEY)
-    client.login(username=USER, password=PASS)
+    ignored = IGNORE_FILENAME in filenames
+    videos = []
+    if not ignored:
+        for filename in sorted(filenames):
+            if is_video_file(filename):
+                videos.append((filename, get_srt_filepath(filename) in filenames))
+
+    return ignored, sorted(subdirs), videos
+
+
+def walk_library(search_root:str, conn:sqlite3.Connection, stats:dict, full_rescan:bool=False):
+    '''
+    walk search_root top down, yielding (dirpath, filepaths) for each directory
+    as soon as it is scanned, where filepaths are the videos missing a subtitle
+    a directory whose mtime and inode match the scan index is not listed again,
+    its cached subdirs and videos are used instead
+    reused/rescanned directory and video counts are added to stats
+    only the stack of directories still to visit is held in memory
+    '''
+    run_id = time.time_ns()
+    stats.setdefault('reused', 0)
+    stats.setdefault('rescanned', 0)
+    stats.setdefault('videos', 0)
+
+    stack = [search_root]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            st = os.stat(dirpath)
+        except OSError:
+            continue
+
+        row = None
+        if not full_rescan:
+            with STATE_DB_LOCK:
+                row = conn.execute(
+                    'SELECT mtime_ns, inode, ignored, subdirs, videos FROM scan_index WHERE dirpath = ?',
+                    (dirpath,),
+                ).fetchone()
+
+        if row is not None and row[0] == st.st_mtime_ns and row[1] == st.st_ino:
+            ignored = bool(row[2])
+            subdirs = json.loads(row[3])
+            videos = json.loads(row[4])
+            with STATE_DB_LOCK:
+                conn.execute('UPDATE scan_index SET run_id = ? WHERE dirpath = ?', (run_id, dirpath))
+            stats['reused'] += 1
+        else:
+            try:
+                with METRICS.timer('scan'):
+                    ignored, subdirs, videos = scan_directory(dirpath)
+            except OSError:
+                continue
+            with STATE_DB_LOCK:
+                conn.execute(
+                    'INSERT OR REPLACE INTO scan_index VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (dirpath, st.st_mtime_ns, st.st_ino, ignored, json.dumps(subdirs), json.dumps(videos), run_id),
+                )
+            stats['rescanned'] += 1
 
-    dir_status = {}
+        # push in reverse so we pop in sorted order, same as a top down os.walk
+        stack.extend(os.path.join(dirpath, d) for d in reversed(subdirs))
 
-    # must go bottom up
-    for dirpath, _, filenames in os.walk(search_root):
         # skip if an ignore subtitle check file exists
-        if '.ignoresubtitlecheck' in filenames:
-            dir_status[dirpath] = (True, [])
+        if ignored:
+            continue
+
+        stats['videos'] += len(videos)
+        missing = [os.path.join(dirpath, filename) for filename, has_sub in videos if not has_sub]
+        if missing:
+            yield dirpath, missing
+
+    # forget directories under this root that no longer exist
+    with STATE_DB_LOCK:
+        conn.execute(
+            'DELETE FROM scan_index WHERE run_id != ? AND (dirpath = ? OR substr(dirpath, 1, ?) = ?)',
+            (run_id, search_root, len(search_root) + 1, search_root + os.sep),
+        )
+        conn.commit()
+
+
+class Inotify:
+    '''
+    just enough of linux inotify, through ctypes so there's nothing to install
+    read() blocks in poll, so waiting for events costs no cpu
+    '''
+    EVENT = struct.Struct('iIII') # wd, mask, cookie, len, then len bytes of nul padded name
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f'inotify_init1: {os.strerror(errno)}')
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+
+    def add_watch(self, path:str, mask:int) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read(self, timeout:float=None) -> list[tuple[int, int, str]]:
+        '''wait up to timeout seconds (forever for None) and return [(wd, mask, name)]'''
+        if not self.poller.poll(None if timeout is None else max(0, timeout) * 1000):
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class RunJournal:
+    '''
+    the videos a run still has to get to, so an interrupted run can be picked up where it stopped
+    videos are added as the walk finds them and removed once they've been dealt with.
+    whatever is left, from a run that was killed mid walk or ran out of quota, is worked
+    through first by the next run, before it walks the library for anything new
+    '''
+    def __init__(self, conn:sqlite3.Connection, search_root:str):
+        self.conn = conn
+        self.search_root = search_root
+        self.lock = STATE_DB_LOCK
+        # videos found by this run queue up behind what earlier runs left
+        with self.lock:
+            row = self.conn.execute('SELECT MAX(position) FROM pending_video WHERE search_root = ?', (search_root,)).fetchone()
+        self.position = (row[0] if row[0] is not None else -1) + 1
+
+    def remaining(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM pending_video WHERE search_root = ?', (self.search_root,)).fetchone()[0]
+
+    def start(self, forget:bool=False) -> bool:
+        '''
+        start journaling a new walk, keeping the videos earlier runs left unless forget
+        returns whether the last run's walk got to the end
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT walk_complete FROM run_journal WHERE search_root = ?', (self.search_root,)).fetchone()
+            if forget:
+                self.conn.execute('DELETE FROM pending_video WHERE search_root = ?', (self.search_root,))
+            self.conn.execute('INSERT OR REPLACE INTO run_journal VALUES (?, 0, ?)', (self.search_root, time.time()))
+            self.conn.commit()
+        return row is None or bool(row[0])
+
+    def add(self, dirpath:str, filepaths:list[str]) -> None:
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO pending_video VALUES (?, ?, ?, ?)',
+                [(filepath, self.search_root, dirpath, self.position + i) for i, filepath in enumerate(filepaths)],
+            )
+            self.conn.commit()
+        self.position += len(filepaths)
+
+    def walk_finished(self) -> None:
+        with self.lock:
+            self.conn.execute('UPDATE run_journal SET walk_complete = 1 WHERE search_root = ?', (self.search_root,))
+            self.conn.commit()
+
+    def done(self, filepaths:list[str]) -> None:
+        with self.lock:
+            self.conn.executemany('DELETE FROM pending_video WHERE filepath = ?', [(filepath,) for filepath in filepaths])
+            self.conn.commit()
+
+    def pending(self) -> list[tuple[str, list[str]]]:
+        '''the journaled videos as [(dirpath, filepaths)] in the order the walk found them'''
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT dirpath, filepath FROM pending_video WHERE search_root = ? ORDER BY position',
+                (self.search_root,),
+            ).fetchall()
+        directories = {}
+        for dirpath, filepath in rows:
+            directories.setdefault(dirpath, []).append(filepath)
+        return list(directories.items())
+
+    def finish(self) -> None:
+        '''drop the journal once nothing is left in it'''
+        if self.remaining() == 0:
+            with self.lock:
+                self.conn.execute('DELETE FROM run_journal WHERE search_root = ?', (self.search_root,))
+                self.conn.commit()
+
+
+class RateLimiter:
+    '''
+    token bucket shared by all workers
+    every api call takes a token, and a 429 pauses the whole bucket for Retry-After seconds
+    '''
+    def __init__(self, rate:float, burst:float=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        '''block until a token is available, returns how long we waited'''
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds:float) -> None:
+        '''stop handing out tokens for the given number of seconds'''
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class SearchCache:
+    '''
+    persistent cache of search results keyed on (name, season, episode, language)
+    a hit stores the file_id of the first result, a miss stores how many times in a row we found nothing
+    '''
+    def __init__(self, conn:sqlite3.Connection):
+        self.conn = conn
+        self.lock = STATE_DB_LOCK
+        self.hits = 0
+        self.misses = 0
+        self.evict()
+
+    @staticmethod
+    def key(name:str, season:int, episode:int, language:str) -> str:
+        return json.dumps([name, season, episode, language])
+
+    @staticmethod
+    def hash_key(moviehash:str, language:str) -> str:
+        '''for videos that can only be searched by moviehash'''
+        return json.dumps(['moviehash', moviehash, language])
+
+    def evict(self) -> None:
+        '''drop entries that expired long ago, then the oldest ones if the cache is over size'''
+        with self.lock:
+            self.conn.execute('DELETE FROM search_cache WHERE expires < ?', (time.time() - CACHE_EVICT_AFTER_DAYS * DAY,))
+            self.conn.execute(
+                'DELETE FROM search_cache WHERE query_key IN '
+                '(SELECT query_key FROM search_cache ORDER BY expires DESC LIMIT -1 OFFSET ?)',
+                (CACHE_MAX_ENTRIES,),
+            )
+            self.conn.commit()
+
+    def get(self, key:str) -> tuple[bool, int, float]:
+        '''
+        return (fresh, file_id, expires)
+        fresh is False when there is no entry or it has expired, file_id is None for a cached miss
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT file_id, expires FROM search_cache WHERE query_key = ?', (key,)).fetchone()
+            if row is None or row[1] < time.time():
+                self.misses += 1
+                return False, None, None
+            self.hits += 1
+            return True, row[0], row[1]
+
+    def put_hit(self, key:str, file_id:int) -> None:
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO search_cache VALUES (?, ?, 0, ?)',
+                (key, file_id, time.time() + HIT_TTL_DAYS * DAY),
+            )
+            self.conn.commit()
+
+    def put_miss(self, key:str) -> None:
+        '''record a miss, pushing the next retry further out each time we miss again'''
+        with self.lock:
+            row = self.conn.execute('SELECT misses FROM search_cache WHERE query_key = ? AND file_id IS NULL', (key,)).fetchone()
+            misses = (row[0] if row else 0) + 1
+            days = MISS_BACKOFF_DAYS[min(misses, len(MISS_BACKOFF_DAYS)) - 1]
+            self.conn.execute(
+                'INSERT OR REPLACE INTO search_cache VALUES (?, NULL, ?, ?)',
+                (key, misses, time.time() + days * DAY),
+            )
+            self.conn.commit()
+
+    def forget(self, key:str) -> None:
+        with self.lock:
+            self.conn.execute('DELETE FROM search_cache WHERE query_key = ?', (key,))
+            self.conn.commit()
+
+
+def compute_moviehash(filepath:str) -> str:
+    '''
+    opensubtitles moviehash: file size plus the sum of the 64 bit little endian words
+    in the first and last 64 KiB, as 16 hex digits. returns None for files too small to hash
+    the file is memory mapped and only those two chunks are ever touched
+    '''
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < HASH_CHUNK_SIZE * 2:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            tail = size - HASH_CHUNK_SIZE
+            # start readahead on both chunks before faulting them in
+            mm.madvise(mmap.MADV_WILLNEED, 0, HASH_CHUNK_SIZE)
+            mm.madvise(mmap.MADV_WILLNEED, tail - tail % mmap.PAGESIZE, size - tail + tail % mmap.PAGESIZE)
+            words = f'<{HASH_CHUNK_SIZE // 8}Q'
+            total = size + sum(struct.unpack_from(words, mm, 0)) + sum(struct.unpack_from(words, mm, tail))
+
+    return f'{total & 0xFFFFFFFFFFFFFFFF:016x}'
+
+
+class HashCache:
+    '''moviehash per video, reused until the file's size or mtime changes'''
+    def __init__(self, conn:sqlite3.Connection):
+        self.conn = conn
+        self.lock = STATE_DB_LOCK
+
+    def get(self, filepath:str) -> str:
+        st = os.stat(filepath)
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT moviehash FROM video_hash WHERE filepath = ? AND size = ? AND mtime_ns = ?',
+                (filepath, st.st_size, st.st_mtime_ns),
+            ).fetchone()
+        if row is not None:
+            return row[0]
+
+        # hash outside the lock so workers hash different files in parallel
+        with METRICS.timer('hash'):
+            moviehash = compute_moviehash(filepath)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO video_hash VALUES (?, ?, ?, ?)',
+                (filepath, st.st_size, st.st_mtime_ns, moviehash),
+            )
+            self.conn.commit()
+        return moviehash
+
+
+def retry_after_seconds(exc:Exception) -> float:
+    '''
+    if exc is a rate limit error, return how long to wait before retrying, otherwise None
+    OpenSubtitlesException wraps the requests HTTPError, so the response is on __context__
+    '''
+    # note: a requests.Response is falsy for error codes, so compare against None explicitly
+    response = getattr(exc.__context__, 'response', None)
+    if response is None:
+        response = getattr(exc, 'response', None)
+    # without a response all there is to go on is the message. with one, a 429 in the message
+    # could just as well be part of a url, a hash or a show name
+    if response is None:
+        if '429' not in str(exc):
+            return None
+    elif response.status_code != 429:
+        return None
+
+    header = response.headers.get('Retry-After') if response is not None else None
+    if header:
+        if header.strip().isdigit():
+            return float(header)
+        retry_at = email.utils.parsedate_to_datetime(header)
+        if retry_at is not None:
+            return max(retry_at.timestamp() - time.time(), 0.0)
+    return DEFAULT_BACKOFF
+
+
+def call_api(limiter:RateLimiter, func, *args, **kwargs):
+    '''call an api function under the rate limiter, retrying on 429'''
+    name = getattr(func, '__name__', 'call')
+    for attempt in range(MAX_RETRIES + 1):
+        METRICS.observe('rate_limit_wait', limiter.acquire())
+        METRICS.count('api_calls')
+        METRICS.count(f'api_{name}')
+        try:
+            with METRICS.timer(f'api_{name}'):
+                return func(*args, **kwargs)
+        except Exception as e:
+            delay = retry_after_seconds(e)
+            if delay is None or attempt == MAX_RETRIES:
+                METRICS.count('api_errors')
+                raise
+            METRICS.count('api_rate_limited')
+            limiter.pause(delay)
+
+
+def describe_video(search_root:str, filepath:str) -> tuple[str, str, dict]:
+    '''
+    work out what to search for a video
+    returns (log_string, cache key, search kwargs), or raises ValueError with the reason
+    '''
+    if 'Movies' in filepath:
+        movie_name = extract_movie_info(search_root, filepath)
+        if movie_name is None:
+            raise ValueError('Failed to extract movie name')
+        key = SearchCache.key(movie_name, None, None, SEARCH_LANGUAGE)
+        return movie_name, key, {'query': movie_name, 'type': 'movie'}
+
+    # is a show
+    show_name, season, episode = extract_show_info(search_root, filepath)
+    if show_name is None or season is None or episode is None:
+        raise ValueError('Failed to extract show name/season/episode')
+    key = SearchCache.key(show_name, season, episode, SEARCH_LANGUAGE)
+    search_kwargs = {'query': show_name, 'season_number': season, 'episode_number': episode, 'type': 'episode'}
+    return f'{show_name} S{season}E{episode}', key, search_kwargs
+
+
+def cached_miss_status(expires:float) -> str:
+    return f'No subtitles found! (cached, retry after {time.strftime("%Y-%m-%d", time.localtime(expires))})'
+
+
+def write_atomic(path:str, content:bytes) -> None:
+    '''write content to a hidden temp file next to path, fsync it and rename it over path'''
+    tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.part')
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def download_subtitle(client, limiter:RateLimiter, cache:SearchCache, key:str, file_id:int, filepath:str) -> str:
+    '''
+    download file_id next to filepath, returns the status for the log line
+    running out of download quota sets QUOTA_EXHAUSTED and returns QUOTA_STATUS
+    '''
+    if QUOTA_EXHAUSTED.is_set():
+        return QUOTA_STATUS
+    try:
+        content = call_api(limiter, client.download, file_id)
+    except Exception as e:
+        if QUOTA_ERROR_RE.search(str(e)):
+            QUOTA_EXHAUSTED.set()
+            return QUOTA_STATUS
+        # the cached file might have been pulled, search again next time
+        if key is not None:
+            cache.forget(key)
+        return f'Failed to download: {e}'
+
+    # an empty .srt would count as subtitled from then on
+    if not content:
+        if key is not None:
+            cache.forget(key)
+        return 'Failed to download: empty subtitle file'
+
+    try:
+        write_atomic(get_srt_filepath(filepath), content)
+    except OSError as e:
+        return f'Failed to save: {e}'
+
+    remaining = getattr(client, 'user_downloads_remaining', None)
+    if remaining is not None and remaining <= 0:
+        QUOTA_EXHAUSTED.set()
+    return 'Successfully downloaded'
+
+
+def search_by_hash(client, limiter:RateLimiter, hashes:HashCache, filepath:str):
+    '''search by moviehash, returns None if the file can't be hashed or nothing matched'''
+    try:
+        moviehash = hashes.get(filepath)
+    except OSError:
+        return None
+    if moviehash is None:
+        return None
+
+    results = call_api(limiter, client.search, moviehash=moviehash, moviehash_match='only', languages=SEARCH_LANGUAGE)
+    if not results or not results.data:
+        return None
+    return results
+
+
+def fetch_subtitle(client, limiter:RateLimiter, cache:SearchCache, hashes:HashCache, search_root:str, filepath:str) -> tuple[str, str]:
+    '''
+    search for and download a subtitle for one video
+    the moviehash is tried first and the name second, unless hashes is None
+    returns (log_string, status) for the log line
+    client only needs search() and download(), so a fake can stand in for OpenSubtitles
+    '''
+    if QUOTA_EXHAUSTED.is_set():
+        return '', QUOTA_STATUS
+    try:
+        log_string, key, search_kwargs = describe_video(search_root, filepath)
+    except ValueError as e:
+        log_string, search_kwargs = '', None
+        # a hash search doesn't need a name, so only give up here if we can't hash either
+        if hashes is None:
+            return '', str(e)
+        name_error = str(e)
+        try:
+            moviehash = hashes.get(filepath)
+        except OSError:
+            moviehash = None
+        if moviehash is None:
+            return '', name_error
+        # cached under the hash instead, so a miss backs off like any other
+        key = SearchCache.hash_key(moviehash, SEARCH_LANGUAGE)
+
+    fresh, file_id, expires = cache.get(key)
+    if fresh and file_id is None:
+        return log_string, cached_miss_status(expires)
+
+    if not fresh:
+        try:
+            results = None
+            if hashes is not None:
+                results = search_by_hash(client, limiter, hashes, filepath)
+            if results is None and search_kwargs is None:
+                cache.put_miss(key)
+                return '', name_error
+            if results is None:
+                results = call_api(limiter, client.search, languages=SEARCH_LANGUAGE, **search_kwargs)
+        except Exception as e:
+            return log_string, f'Failed API query: {e}'
+
+        if not results or not results.data:
+            cache.put_miss(key)
+            return log_string, 'No subtitles found!'
+
+        # download the first subtitle result
+        file_id = results.data[0].file_id
+        cache.put_hit(key, file_id)
+
+    return log_string, download_subtitle(client, limiter, cache, key, file_id, filepath)
+
+
+def fetch_season(client, limiter:RateLimiter, cache:SearchCache, hashes:HashCache, search_root:str,
+                 show_name:str, season:int, filepaths:list[str]) -> dict[str, tuple[str, str]]:
+    '''
+    fetch subtitles for several episodes of one season with a single season-wide search
+    results are paged through until every episode is matched, then matched back to episodes locally
+    returns {filepath: (log_string, status)}
+    '''
+    if QUOTA_EXHAUSTED.is_set():
+        return {filepath: ('', QUOTA_STATUS) for filepath in filepaths}
+    statuses = {}
+    wanted = {} # episode -> [(filepath, log_string, key)]
+    for filepath in filepaths:
+        log_string, key, search_kwargs = describe_video(search_root, filepath)
+        fresh, file_id, expires = cache.get(key)
+        if fresh and file_id is None:
+            statuses[filepath] = (log_string, cached_miss_status(expires))
+        elif fresh:
+            statuses[filepath] = (log_string, download_subtitle(client, limiter, cache, key, file_id, filepath))
+        else:
+            wanted.setdefault(search_kwargs['episode_number'], []).append((filepath, log_string, key))
+
+    found = {} # episode -> file_id of the first (most downloaded) result
+    page = total_pages = 1
+    error = None
+    while wanted.keys() - found.keys() and page <= min(total_pages, MAX_SEASON_PAGES):
+        try:
+            results = call_api(
+                limiter, client.search,
+                query=show_name, season_number=season, type='episode', languages=SEARCH_LANGUAGE, page=page,
+            )
+        except Exception as e:
+            error = f'Failed API query: {e}'
+            break
+
+        for subtitle in results.data or []:
+            if subtitle.season_number not in (None, season):
+                continue
+            if subtitle.episode_number in wanted and subtitle.episode_number not in found:
+                found[subtitle.episode_number] = subtitle.file_id
+        total_pages = results.total_pages or 1
+        page += 1
+    exhausted = error is None and page > total_pages
+
+    for episode, videos in wanted.items():
+        for filepath, log_string, key in videos:
+            if episode in found:
+                cache.put_hit(key, found[episode])
+                statuses[filepath] = (log_string, download_subtitle(client, limiter, cache, key, found[episode], filepath))
+            elif exhausted:
+                cache.put_miss(key)
+                statuses[filepath] = (log_string, 'No subtitles found!')
+            elif error is not None:
+                statuses[filepath] = (log_string, error)
+            else:
+                # ran out of pages we're willing to read, ask for this episode directly
+                statuses[filepath] = fetch_subtitle(client, limiter, cache, hashes, search_root, filepath)
+
+    return statuses
+
+
+def submit_directory(pool:ThreadPoolExecutor, client, limiter:RateLimiter, cache:SearchCache, hashes:HashCache,
+                     search_root:str, filepaths:list[str], season_batch:bool) -> list:
+    '''
+    queue the videos of one directory, returns [(filepath, future)]
+    each future resolves to {filepath: (log_string, status)}
+    with season_batch, episodes from the same show and season share one season-wide search
+    and are matched by name only, since a per-episode hash search would undo the batching
+    '''
+    def single(filepath):
+        return {filepath: fetch_subtitle(client, limiter, cache, hashes, search_root, filepath)}
+
+    seasons = {}
+    singles = []
+    for filepath in filepaths:
+        if season_batch and 'Movies' not in filepath:
+            show_name, season, episode = extract_show_info(search_root, filepath)
+            if season is not None and episode is not None:
+                seasons.setdefault((show_name, season), []).append(filepath)
+                continue
+        singles.append(filepath)
+
+    futures = {}
+    for (show_name, season), group in seasons.items():
+        if len(group) == 1:
+            singles.extend(group)
             continue
-        
-        all_good = True
-        table = []
+        future = pool.submit(fetch_season, client, limiter, cache, hashes, search_root, show_name, season, group)
+        for filepath in group:
+            futures[filepath] = future
+    for filepath in singles:
+        futures[filepath] = pool.submit(single, filepath)
+
+    # keep the directory's own order for logging
+    return [(filepath, futures[filepath]) for filepath in filepaths]
+
+
+def status_reason(status:str) -> str:
+    '''what a log line's status boils down to, for the metrics. None for a download'''
+    if status == 'Successfully downloaded':
+        return None
+    if status.startswith('No subtitles found! (cached'):
+        return 'cached_miss'
+    if status.startswith('No subtitles found!'):
+        return 'not_found'
+    if status.startswith('Failed API query'):
+        return 'api_error'
+    if status.startswith('Failed to download') or status.startswith('Failed to save'):
+        return 'download_error'
+    if status == QUOTA_STATUS:
+        return 'quota'
+    if status.startswith('Failed to extract'):
+        return 'unparsed_name'
+    return 'other'
+
+
+def log_directory(search_root:str, dirpath:str, futures:list, journal:RunJournal=None) -> None:
+    '''
+    wait for a directory's videos and log them together under the directory name
+    videos that were dealt with come off the journal, ones skipped for quota stay on it
+    '''
+    logging.info(f'  {os.path.relpath(dirpath, search_root)}')
+    done = []
+    for filepath, future in futures:
+        log_string, status = future.result()[filepath]
+        logging.info(f'      {os.path.relpath(filepath, dirpath):40} | {log_string:30} | {status}')
+        reason = status_reason(status)
+        if reason is None:
+            METRICS.count('downloaded')
+        else:
+            METRICS.fail(reason)
+        if reason != 'quota':
+            done.append(filepath)
+    if journal is not None:
+        journal.done(done)
+
+
+def audit_library(search_root:str, conn:sqlite3.Connection, workers:int, full_rescan:bool=False) -> tuple[dict, dict]:
+    '''
+    find the videos missing subtitles without touching the api, walking each top level
+    directory on its own thread. returns ({show: {season: [filepaths]}}, scan stats)
+    movies are grouped under their movie name, and season is None when it can't be told
+    '''
+    ignored, subdirs, _ = scan_directory(search_root)
+    if ignored:
+        return {}, {'reused': 0, 'rescanned': 1, 'videos': 0}
+
+    def walk(top):
+        stats = {} # one per thread, summed below
+        missing = [filepath for _, filepaths in walk_library(top, conn, stats, full_rescan) for filepath in filepaths]
+        return missing, stats
+
+    shows = {}
+    totals = collections.Counter(rescanned=1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for missing, stats in pool.map(walk, [os.path.join(search_root, d) for d in subdirs]):
+            totals.update(stats)
+            for filepath in missing:
+                if 'Movies' in os.path.relpath(filepath, search_root):
+                    show_name, season = extract_movie_info(search_root, filepath), None
+                else:
+                    show_name, season, _ = extract_show_info(search_root, filepath)
+                shows.setdefault(show_name, {}).setdefault(season, []).append(filepath)
+    return shows, dict(totals)
 
-        # check all video files in this dir
-        for filename in filenames:
-            if not is_video_file(filename):
+
+def build_report(search_root:str, shows:dict, stats:dict) -> dict:
+    '''the audit as plain data, shows and seasons sorted, paths relative to search_root'''
+    report_shows = []
+    for show_name in sorted(shows, key=str.lower):
+        seasons = shows[show_name]
+        report_shows.append({
+            'show': show_name,
+            'missing': sum(len(filepaths) for filepaths in seasons.values()),
+            'seasons': [
+                {
+                    'season': season,
+                    'missing': len(seasons[season]),
+                    'files': sorted(os.path.relpath(filepath, search_root) for filepath in seasons[season]),
+                }
+                for season in sorted(seasons, key=lambda season: (season is None, season))
+            ],
+        })
+    return {
+        'root': search_root,
+        'generated': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'totals': {
+            'videos': stats.get('videos', 0),
+            'missing': sum(show['missing'] for show in report_shows),
+            'shows': len(report_shows),
+        },
+        'shows': report_shows,
+    }
+
+
+def write_report(report:dict, path:str) -> None:
+    '''
+    write the audit to path, or stdout for -
+    a .csv path gets one row per show and season plus a total row, anything else gets the json
+    '''
+    if path == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+        return
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        if path.lower().endswith('.csv'):
+            writer = csv.writer(f)
+            writer.writerow(['show', 'season', 'missing'])
+            for show in report['shows']:
+                for season in show['seasons']:
+                    writer.writerow([show['show'], '' if season['season'] is None else season['season'], season['missing']])
+            writer.writerow(['TOTAL', '', report['totals']['missing']])
+        else:
+            json.dump(report, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def watch_library(search_root:str, client, limiter:RateLimiter, cache:SearchCache, hashes:HashCache, workers:int,
+                  checkpoint=None) -> None:
+    '''
+    fetch subtitles for videos as they show up under search_root, until interrupted
+    every directory gets an inotify watch, new ones as they're created or moved in.
+    a video is fetched once its size has stayed the same for WATCH_SETTLE_SECONDS,
+    so files still being written aren't picked up half done
+    checkpoint, if given, is called every WATCH_METRICS_SECONDS
+    '''
+    inotify = Inotify()
+    watched = {} # wd -> dirpath
+    settling = {} # filepath -> (size at the last check, when it was last checked or touched)
+    deferred = set() # skipped because the quota ran out
+    deferred_lock = threading.Lock()
+    out_of_watches = False
+
+    def watch_tree(top:str, since:float=0) -> None:
+        '''
+        watch top and everything under it (watching a directory twice is harmless), and queue
+        the videos in there that lack subtitles and were written or moved in since since
+        (a time.time()), none if since is None
+        '''
+        nonlocal out_of_watches
+        stack = [top]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                watched[inotify.add_watch(dirpath, WATCH_MASK)] = dirpath
+                ignored, subdirs, videos = scan_directory(dirpath)
+            except OSError as e:
+                if e.errno == 28 and not out_of_watches: # ENOSPC
+                    logging.info('Ran out of inotify watches, raise fs.inotify.max_user_watches')
+                    out_of_watches = True
+                continue
+            stack.extend(os.path.join(dirpath, d) for d in subdirs)
+            if ignored or since is None:
                 continue
-            filepath = os.path.join(dirpath, filename)
-            srt_path = get_srt_filepath(filepath)
-            has_sub = os.path.exists(srt_path)
-            if not has_sub:
-                all_good = False
-
-            table.append({
-                'filepath': filepath,
-                'has_sub': has_sub,
-            })
-        
-        dir_status[dirpath] = (all_good, table)
-
-    # now we go through the elements that we saved as not having subs
-    # log them and attempt to retrieve subtitles
-    for dirpath, (all_good, table) in dir_status.items():
-        if not all_good:
-            logging.info(f'  {os.path.relpath(dirpath, search_root)}')
-            
-            for element in table:
-                filepath = element['filepath']
-                has_sub = element['has_sub']
-                if has_sub:
+            for filename, has_sub in videos:
+                filepath = os.path.join(dirpath, filename)
+                if has_sub or filepath in settling:
                     continue
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                # a rename bumps ctime but keeps mtime
+                if max(st.st_mtime, st.st_ctime) >= since:
+                    settling[filepath] = (None, time.monotonic())
+
+    def fetched(filepath, future):
+        try:
+            log_string, status = future.result()
+        except Exception as e:
+            log_string, status = '', f'Failed: {e}'
+        logging.info(f'  {os.path.relpath(filepath, search_root):60} | {log_string:30} | {status}')
+        reason = status_reason(status)
+        if reason is None:
+            METRICS.count('downloaded')
+        else:
+            METRICS.fail(reason)
+        if status == QUOTA_STATUS:
+            with deferred_lock:
+                deferred.add(filepath)
 
-                if 'Movies' in filepath:
-                    movie_name = extract_movie_info(search_root, filepath)
-                    log_string = movie_name
-                    if movie_name is None:
-                        logging.info(f'      {os.path.relpath(filepath, dirpath):40} | {"":30} | Failed to extract movie name')
+    def fetch(filepath):
+        dirpath = os.path.dirname(filepath)
+        if os.path.exists(get_srt_filepath(filepath)) or os.path.exists(os.path.join(dirpath, IGNORE_FILENAME)):
+            return
+        future = pool.submit(fetch_subtitle, client, limiter, cache, hashes, search_root, filepath)
+        future.add_done_callback(lambda f: fetched(filepath, f))
+
+    logging.info(f'Watching {search_root} for new videos')
+    quota_checked = None
+    next_checkpoint = time.monotonic() + WATCH_METRICS_SECONDS
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # videos already in the library are left to the regular runs
+        started = time.time()
+        watch_tree(search_root, since=None)
+        logging.info(f'Watching {len(watched)} directories')
+
+        try:
+            while True:
+                # sleep until the next event, or until something settling is due a look
+                now = time.monotonic()
+                deadlines = [seen + WATCH_SETTLE_SECONDS for _, seen in settling.values()]
+                if QUOTA_EXHAUSTED.is_set():
+                    quota_checked = quota_checked or now
+                    deadlines.append(quota_checked + QUOTA_RECHECK_SECONDS)
+                if checkpoint is not None:
+                    deadlines.append(next_checkpoint)
+                timeout = min(deadlines) - now if deadlines else None
+
+                for wd, mask, name in inotify.read(timeout):
+                    if mask & IN_Q_OVERFLOW:
+                        # events were dropped. watch any directories that were missed, and pick
+                        # up the videos that arrived since the watch started and still lack subtitles
+                        logging.info('inotify queue overflowed, looking for what was missed')
+                        watch_tree(search_root, since=started)
+                        continue
+                    if mask & IN_IGNORED:
+                        watched.pop(wd, None)
                         continue
+                    dirpath = watched.get(wd)
+                    if dirpath is None:
+                        continue
+                    path = os.path.join(dirpath, name)
+                    if mask & IN_ISDIR:
+                        # a new directory, or a finished torrent moved in whole
+                        watch_tree(path)
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and is_video_file(name):
+                        settling[path] = (None, time.monotonic())
 
+                now = time.monotonic()
+                for filepath, (size, seen) in list(settling.items()):
+                    if now - seen < WATCH_SETTLE_SECONDS:
+                        continue
                     try:
-                        results = client.search(
-                            query=movie_name, 
-                            type='movie', 
-                            languages='en'
-                        )
-                    except Exception as e:
-                        logging.info(f'      {os.path.relpath(filepath, dirpath):40} | {log_string:30} | Failed API query: {e}')
+                        current = os.stat(filepath).st_size
+                    except OSError:
+                        del settling[filepath]
                         continue
-
-                else: # is a show
-                    show_name, season, episode = extract_show_info(search_root, filepath)
-                    if show_name is None or season is None or episode is None:
-                        logging.info(f'      {os.path.relpath(filepath, dirpath):40} | {"":30} | Failed to extract show name/season/episode')
+                    if current != size:
+                        # still growing, or the first look. check again later
+                        settling[filepath] = (current, now)
                         continue
-                    log_string = f'{show_name} S{season}E{episode}'
+                    del settling[filepath]
+                    fetch(filepath)
 
+                if checkpoint is not None and now >= next_checkpoint:
+                    checkpoint()
+                    next_checkpoint = now + WATCH_METRICS_SECONDS
+
+                if quota_checked is not None and now - quota_checked >= QUOTA_RECHECK_SECONDS:
+                    quota_checked = now
                     try:
-                        results = client.search(
-                            query=show_name,
-                            season_number=season,
-                            episode_number=episode,
-                            type='episode',
-                            languages='en',
-                        )
+                        call_api(limiter, client.user_info)
                     except Exception as e:
-                        logging.info(f'      {os.path.relpath(filepath, dirpath):40} | {log_string:30} | Failed API query: {e}')
+                        logging.info(f'Could not check the download quota: {e}')
                         continue
-                    
-                if not results or not results.data:
-                    logging.info(f'      {os.path.relpath(filepath, dirpath):40} | {log_string:30} | No subtitles found!')
-                    continue
+                    if client.user_downloads_remaining > 0:
+                        logging.info(f'Download quota is back ({client.user_downloads_remaining}), retrying skipped videos')
+                        QUOTA_EXHAUSTED.clear()
+                        quota_checked = None
+                        with deferred_lock:
+                            retry = list(deferred)
+                            deferred.clear()
+                        for filepath in retry:
+                            fetch(filepath)
+        except KeyboardInterrupt:
+            logging.info('Stopped watching')
+        finally:
+            inotify.close()
 
-                # download the first subtitle result
-                try:
-                    srt_path = get_srt_filepath(filepath)
-                    client.download_and_save(results.data[0], filename=srt_path)
-                    logging.info(f'      {os.path.relpath(filepath, dirpath):40} | {log_string:30} | Successfully downloaded')
-                except Exception as e:
-                    logging.info(f'      {os.path.relpath(filepath, dirpath):40} | {log_string:30} | Failed to download: {e}')
-                    continue
-                
-                time.sleep(5) # be nice to the api
+
+def write_metrics(args, scan_stats:dict, missing:int) -> None:
+    '''add the run totals to METRICS and write them where the command line asked'''
+    METRICS.count('dirs_reused', scan_stats.get('reused', 0))
+    METRICS.count('dirs_rescanned', scan_stats.get('rescanned', 0))
+    METRICS.count('videos', scan_stats.get('videos', 0))
+    METRICS.count('missing', missing)
+    save_metrics(args)
+
+
+def save_metrics(args, announce:bool=True) -> None:
+    '''write METRICS where the command line asked, the same file every time for one run'''
+    path = args.metrics or os.path.join(METRICS_DIR, time.strftime('%Y%m%d-%H%M%S', time.localtime(METRICS.started)) + '.json')
+    try:
+        METRICS.write_json(path)
+        if args.prometheus:
+            METRICS.write_prometheus(args.prometheus)
+    except OSError as e:
+        logging.info(f'Could not write metrics: {e}')
+        return
+    if announce:
+        logging.info(f'Metrics written to {path}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='find videos without subtitles and download them from opensubtitles.com')
+    parser.add_argument('directory', help='library root containing show directories and a Movies directory')
+    parser.add_argument('--full-rescan', action='store_true', help='ignore the scan index and list every directory again')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help=f'concurrent search/download workers (default {DEFAULT_WORKERS})')
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help=f'max api requests per second (default {DEFAULT_RATE})')
+    parser.add_argument('--season-batch', action='store_true', help='search once per show season instead of once per episode')
+    parser.add_argument('--no-hash', action='store_true', help='match by name only, without trying the moviehash first')
+    parser.add_argument('--no-resume', action='store_true', help='forget the videos earlier runs left queued')
+    parser.add_argument('--dry-run', action='store_true', help="only report what's missing, without logging in")
+    parser.add_argument('--watch', action='store_true', help='keep running and fetch subtitles for new videos as they appear')
+    parser.add_argument('--report', default='-', help='where --dry-run writes its report, .csv or json (default stdout)')
+    parser.add_argument('--metrics', help=f'where to write this run\'s metrics json (default {METRICS_DIR}/<start time>.json)')
+    parser.add_argument('--prometheus', help='also write the metrics in prometheus textfile format here')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.rate <= 0:
+        parser.error('--rate must be positive')
+
+    search_root = os.path.abspath(args.directory)
+    if not os.path.isdir(search_root):
+        print(f'Error: {search_root} is not a directory')
+        sys.exit(1)
+
+    start_time = time.strftime('%Y-%m-%d %H:%M:%S')
+    logging.info(f'==== Subtitle check started at {start_time} ====')
+    logging.info(f'Searching for subtitles in {search_root}')
+
+    if args.dry_run:
+        started = time.perf_counter()
+        conn = open_state_db(STATE_DB_PATH)
+        shows, scan_stats = audit_library(search_root, conn, args.workers, full_rescan=args.full_rescan)
+        report = build_report(search_root, shows, scan_stats)
+        write_report(report, args.report)
+        totals = report['totals']
+        write_metrics(args, scan_stats, totals['missing'])
+        logging.info(f'Scan index: reused {scan_stats["reused"]} directories, rescanned {scan_stats["rescanned"]}')
+        logging.info(f'{totals["missing"]} of {totals["videos"]} videos in {totals["shows"]} shows are missing subtitles, '
+                     f'audited in {time.perf_counter() - started:.2f}s')
+        logging.info(f'==== Subtitle check ended at {time.strftime("%Y-%m-%d %H:%M:%S")} ====\n\n')
+        return
+
+    USER, PASS, API_KEY = get_api_key()
+    client = OpenSubtitles(user_agent='SubtitleGrabber', api_key=API_KEY)
+    with METRICS.timer('login'):
+        client.login(username=USER, password=PASS)
+
+    conn = open_state_db(STATE_DB_PATH)
+    limiter = RateLimiter(args.rate)
+    cache = SearchCache(conn)
+    hashes = None if args.no_hash else HashCache(conn)
+
+    if args.watch:
+        counted = {'cache_hits': 0, 'cache_misses': 0}
+
+        def checkpoint(announce:bool=False):
+            # the cache keeps running totals, only what's new since the last checkpoint is added
+            for name, total in (('cache_hits', cache.hits), ('cache_misses', cache.misses)):
+                METRICS.count(name, total - counted[name])
+                counted[name] = total
+            if client.user_downloads_remaining is not None:
+                METRICS.set('downloads_remaining', client.user_downloads_remaining)
+            save_metrics(args, announce)
+
+        # a service manager stops the watch with SIGTERM, which should end it like ctrl-c does
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        watch_library(search_root, client, limiter, cache, hashes, args.workers, checkpoint)
+        # the workers are done by now, so the last downloads are counted
+        checkpoint(announce=True)
+        return
+
+    scan_stats = {}
+    missing = 0
+
+    journal = RunJournal(conn, search_root)
+    last_walk_complete = journal.start(forget=args.no_resume)
+    backlog = journal.pending()
+    resumed = {filepath for _, filepaths in backlog for filepath in filepaths}
+    if resumed:
+        left_by = 'earlier runs' if last_walk_complete else 'an interrupted run'
+        logging.info(f'Resuming the {len(resumed)} videos {left_by} left queued')
+        METRICS.count('resumed', len(resumed))
+
+    def directories():
+        '''the journaled videos first, then the walk for anything that turned up since'''
+        for dirpath, filepaths in backlog:
+            # anything sorted out since the last run is dropped without an api call
+            gone = {fp for fp in filepaths if not os.path.exists(fp) or os.path.exists(get_srt_filepath(fp))}
+            journal.done(list(gone))
+            yield dirpath, [fp for fp in filepaths if fp not in gone]
+        for dirpath, filepaths in walk_library(search_root, conn, scan_stats, full_rescan=args.full_rescan):
+            filepaths = [fp for fp in filepaths if fp not in resumed]
+            journal.add(dirpath, filepaths)
+            yield dirpath, filepaths
+
+    # directories stream out of the journal and the walk straight into the workers.
+    # searches and downloads run concurrently, but we log one directory at a time in walk order
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        pending = collections.deque()
+        queued = 0
+        for dirpath, filepaths in directories():
+            missing += len(filepaths)
+            # out of quota: the rest of the walk is only journaled for the next run
+            if not filepaths or QUOTA_EXHAUSTED.is_set():
+                continue
+
+            futures = submit_directory(pool, client, limiter, cache, hashes, search_root, filepaths, args.season_batch)
+            pending.append((dirpath, futures))
+            queued += len(futures)
+
+            # log directories that are done, and block on the oldest one if too much is queued
+            while pending and (queued > MAX_QUEUED_VIDEOS or all(f.done() for _, f in pending[0][1])):
+                dirpath, futures = pending.popleft()
+                log_directory(search_root, dirpath, futures, journal)
+                queued -= len(futures)
+
+        journal.walk_finished()
+        while pending:
+            log_directory(search_root, *pending.popleft(), journal)
+
+    journal.finish()
+    if QUOTA_EXHAUSTED.is_set():
+        logging.info(f'Download quota reached, {journal.remaining()} videos left queued for the next run')
+
+    logging.info(f'Scan index: reused {scan_stats["reused"]} directories, rescanned {scan_stats["rescanned"]}')
+    logging.info(f'Search cache: {cache.hits} hits, {cache.misses} misses')
+    METRICS.count('cache_hits', cache.hits)
+    METRICS.count('cache_misses', cache.misses)
+    if client.user_downloads_remaining is not None:
+        METRICS.set('downloads_remaining', client.user_downloads_remaining)
+    write_metrics(args, scan_stats, missing)
     end_time = time.strftime('%Y-%m-%d %H:%M:%S')
     logging.info(f'subtitle check that started at {start_time} ended at {end_time}')
     logging.info(f'==== Subtitle check ended at {end_time} ====\n\n')
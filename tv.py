@@ -5,16 +5,40 @@ media player launcher
 
 searches within a start directory for a search string
 outputs all matches and opens your selection in Celluloid, my preferred media player
+
+the directory tree is cached in ~/.cache/tv_index.pickle. on each run only directories
+whose mtime changed are listed again, pass --reindex to rebuild it from scratch
+
+matches are ranked fzf style: every query char has to appear in order, and runs of
+consecutive chars and matches at the start of words score higher than scattered ones.
+a trigram index over the paths narrows down the candidates before anything is scored
 '''
 
+import heapq
 import os
+import pickle
 import subprocess
 import sys
+import time
 
+from array import array
 from string import punctuation, whitespace
 
 
 start_dir = os.path.expanduser('~/Torrents')
+index_path = os.path.expanduser('~/.cache/tv_index.pickle')
+
+# how many ranked matches to show
+max_results = 20
+
+# match scoring, loosely after fzf
+SCORE_MATCH = 16
+BONUS_CONSECUTIVE = 8
+BONUS_WORD_START = 8
+BONUS_PATH_START = 10 # start of a path component
+PENALTY_GAP_START = 3
+PENALTY_GAP_EXTENSION = 1
+WORD_SEPARATORS = set(punctuation + whitespace)
 
 
 def clean_string(s:str) -> str:
@@ -22,43 +46,188 @@ def clean_string(s:str) -> str:
     return ''.join(c for c in s if c not in punctuation and c not in whitespace).lower()
 
 
-def list_dirs(startdir:str) -> list[str]:
-    '''returns a list of all subdirs from the start dirpath'''
-    result = []
+def load_index(path:str, startdir:str) -> dict:
+    '''load the cached directory tree, or an empty one if it's missing or for another start dir'''
+    try:
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
+    if index.get('start_dir') != startdir:
+        return {}
+    return index
+
+
+def save_index(path:str, index:dict) -> None:
+    '''write the index to a temp file and rename it over the old one'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def build_trigrams(dirs:list[str]) -> dict[str, array]:
+    '''map every trigram of each cleaned dir to the (ascending) indexes of the dirs containing it'''
+    postings = {}
+    for i, d in enumerate(dirs):
+        text = clean_string(d)
+        for tri in {text[j:j + 3] for j in range(len(text) - 2)}:
+            postings.setdefault(tri, array('I')).append(i)
+    return postings
+
+
+def list_dirs(startdir:str, index:dict=None) -> tuple[list[str], list[str], int]:
+    '''
+    returns (all subdirs from the start dirpath, their lowercased forms, directories listed)
+    with an index from load_index, a directory whose mtime hasn't changed reuses its cached
+    subdirs instead of being listed again. the index is updated in place, including
+    the trigram postings find_matches uses
+    '''
     if not os.path.isdir(startdir):
         raise FileNotFoundError(f'Start path {startdir} is not a valid directory')
-    
-    for root, _, _ in os.walk(startdir):
-        result.append(os.path.relpath(root, startdir))
 
-    return result
+    old_tree = index.get('tree', {}) if index is not None else {}
+    tree = {} # relpath -> [mtime_ns, subdir names]
+    listed = 0
+
+    stack = ['.']
+    while stack:
+        rel = stack.pop()
+        full = os.path.join(startdir, rel)
+        try:
+            mtime_ns = os.stat(full).st_mtime_ns
+        except OSError:
+            continue
+
+        cached = old_tree.get(rel)
+        if cached is not None and cached[0] == mtime_ns:
+            subdirs = cached[1]
+        else:
+            try:
+                with os.scandir(full) as it:
+                    subdirs = sorted(e.name for e in it if e.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+            listed += 1
+        tree[rel] = [mtime_ns, subdirs]
+
+        stack.extend(d if rel == '.' else os.path.join(rel, d) for d in reversed(subdirs))
 
+    result = list(tree)
+    if index is not None:
+        if listed or len(tree) != len(old_tree):
+            index.clear()
+            index.update(
+                start_dir=startdir,
+                tree=tree,
+                lowered=[d.lower() for d in result],
+                trigrams=build_trigrams(result),
+            )
+        lowered = index['lowered']
+    else:
+        lowered = [d.lower() for d in result]
+
+    return result, lowered, listed
 
-def can_be_found_subsequently(query:str, text:str) -> bool:
-    '''check if query chars appear in order in text'''
-    q_i = 0 # query index
-    t_i = 0 # text index
-    while q_i < len(query) and t_i < len(text):
-        if query[q_i] == text[t_i]:
+
+def score_match(query:str, text:str) -> int:
+    '''
+    score how well query matches text, or None if query's chars don't all appear in order
+    like fzf, find the earliest place the match can end, then walk back from there
+    to find the tightest window, and score the matched chars inside it
+    '''
+    # forward pass: earliest end of a match
+    q_i = 0
+    end = None
+    for t_i, c in enumerate(text):
+        if c == query[q_i]:
             q_i += 1
-        t_i += 1
-    return q_i == len(query)
+            if q_i == len(query):
+                end = t_i
+                break
+    if end is None:
+        return None
+
+    # backward pass: latest start that still matches, which gives the shortest window
+    q_i = len(query) - 1
+    start = end
+    for t_i in range(end, -1, -1):
+        if text[t_i] == query[q_i]:
+            q_i -= 1
+            if q_i < 0:
+                start = t_i
+                break
+
+    score = 0
+    q_i = 0
+    prev_match = -2
+    in_gap = False
+    for t_i in range(start, end + 1):
+        c = text[t_i]
+        if q_i < len(query) and c == query[q_i]:
+            score += SCORE_MATCH
+            if t_i == 0 or text[t_i - 1] == os.sep:
+                score += BONUS_PATH_START
+            elif text[t_i - 1] in WORD_SEPARATORS:
+                score += BONUS_WORD_START
+            if prev_match == t_i - 1:
+                score += BONUS_CONSECUTIVE
+            prev_match = t_i
+            q_i += 1
+            in_gap = False
+        else:
+            score -= PENALTY_GAP_EXTENSION if in_gap else PENALTY_GAP_START
+            in_gap = True
+    return score
+
 
+def candidates(word:str, count:int, trigrams:dict[str, array]):
+    '''
+    indexes of the dirs whose cleaned form has every trigram of word
+    falls back to every dir when word is too short to have trigrams
+    '''
+    if trigrams is None or len(word) < 3:
+        return range(count)
 
-def find_matches(query:str, dirs:list[str]) -> list[str]:
-    '''find dirs that contain query's first word and then remaining chars in order'''
-    # split query into first word and rest
+    # intersect starting from the rarest trigram so the working set stays small
+    postings = sorted(
+        (trigrams.get(word[j:j + 3], array('I')) for j in range(len(word) - 2)),
+        key=len,
+    )
+    result = set(postings[0])
+    for posting in postings[1:]:
+        if not result:
+            break
+        result.intersection_update(posting)
+    return sorted(result)
+
+
+def find_matches(query:str, dirs:list[str], lowered:list[str]=None, trigrams:dict[str, array]=None,
+                 limit:int=max_results) -> list[str]:
+    '''
+    return the best limit dirs for query, best first
+    the query's first word narrows the candidates through the trigram index,
+    then the whole query is scored against each candidate and only the top few are kept
+    lowered is dirs already lowercased, so it can come precomputed from the index
+    '''
     words = query.split()
     if not words:
         return []
     first_word = clean_string(words[0])
-    remaining = clean_string(''.join(words[1:]))
-
-    first_matches = [d for d in dirs if first_word in d.lower()]
+    full_query = clean_string(''.join(words))
+    if not full_query:
+        return []
+    if lowered is None:
+        lowered = [d.lower() for d in dirs]
 
-    if remaining:
-        return [d for d in first_matches if can_be_found_subsequently(remaining, d.lower())]
-    return first_matches
+    scored = (
+        (score, -len(dirs[i]), dirs[i])
+        for i in candidates(first_word, len(dirs), trigrams)
+        if (score := score_match(full_query, lowered[i])) is not None
+    )
+    # a heap keeps the top few without sorting every match
+    return [d for _, _, d in heapq.nlargest(limit, scored)]
 
 
 def prompt_and_select(matches: list[str]) -> str:
@@ -66,8 +235,6 @@ def prompt_and_select(matches: list[str]) -> str:
     if not matches:
         print('No matches found!')
         sys.exit(1)
-    
-    matches = sorted(matches)
 
     for i, d in enumerate(matches, start=1):
         # print with ANSI escape codes for bold index text
@@ -93,13 +260,27 @@ def open_in_celluloid(path:str) -> None:
 
 
 def main() -> None:
-    if len(sys.argv) == 1:
+    args = sys.argv[1:]
+    reindex = '--reindex' in args
+    args = [a for a in args if a != '--reindex']
+
+    if not args:
         query = input("Enter the tv show or movie you'd like to play: ")
     else:
-        query = ' '.join(sys.argv[1:])
+        query = ' '.join(args)
+
+    start = time.perf_counter()
+    index = {} if reindex else load_index(index_path, start_dir)
+    dirs, lowered, listed = list_dirs(start_dir, index)
+    if listed:
+        save_index(index_path, index)
+    indexed = time.perf_counter()
+
+    matches = find_matches(query, dirs, lowered, index.get('trigrams'))
+    matched = time.perf_counter()
+    print(f'{len(dirs)} dirs ({listed} listed) indexed in {(indexed - start) * 1000:.1f} ms, '
+          f'searched in {(matched - indexed) * 1000:.1f} ms')
 
-    dirs = list_dirs(start_dir)
-    matches = find_matches(query, dirs)
     selection = prompt_and_select(matches)
     print(f'Opening {selection} in Celluloid...')
     open_in_celluloid(selection)